@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import collections
 import hashlib
 import logging
 import traceback
@@ -11,29 +12,155 @@ import asyncpg
 import discord
 from discord.ext import commands
 
+from config import CONFIG_PATH, RESTART_KEYS, Config
+from errors import ErrorAggregator
+from events import EventLog
+from metrics import Counter, Gauge, TimedPool, start_http_server
+from migrate import apply_migrations
+from outbound import Outbox
+from rewards import RewardReconciler
+from storage import MemoryStorage, PostgresStorage, create_pool
+from supervisor import TaskSupervisor
 
-class DropBot(commands.Bot):
-    def __init__(self, *args, config=None, **kwargs):
+
+# events held back until warm_up has finished, everything else (ready, connect...) passes straight through
+WARM_UP_EVENTS = frozenset({"message", "message_edit", "storage_event"})
+
+WARM_UP_BUFFERED = Gauge("dropbot_warm_up_buffered", "Events held back until the bot has warmed up")
+WARM_UP_OVERFLOW = Counter("dropbot_warm_up_overflow_total", "Events discarded because the warm-up buffer was full")
+
+
+class DropBot(commands.AutoShardedBot):
+    def __init__(self, *args, config=None, config_path=CONFIG_PATH, **kwargs):
+        config = config if isinstance(config, Config) else Config(config or {})
+        if config.get("shard_ids") is not None:
+            # run only these shards in this process, the others run elsewhere against the same database
+            kwargs.setdefault("shard_ids", list(config["shard_ids"]))
+            kwargs.setdefault("shard_count", config.get("shard_count"))
         super().__init__(*args, **kwargs)
 
-        self.config = config or {}
+        self.config = config
+        self.config_path = config_path
+        self.granted_guilds = frozenset()
         self.db = None
+        self.storage = None
+        self.storage_listener = None
+        self.metrics_server = None
         self.db_available = asyncio.Event()
+        self.warmed_up = asyncio.Event()
+        self._warm_up_buffer = collections.deque(maxlen=self.config.get("warm_up_buffer", 1000))
+        WARM_UP_BUFFERED.set_function(lambda: len(self._warm_up_buffer))
         self.logger = logging.getLogger("dropbot")
         self.session = aiohttp.ClientSession(loop=self.loop)
+        self.outbox = Outbox(
+            self,
+            concurrency=self.config.get("send_concurrency", 4),
+            announce_window=self.config.get("announce_window", 3.0),
+            announce_burst=self.config.get("announce_burst", 5),
+        )
+        self.outbox.start()
+        self.events = EventLog(
+            self,
+            flush_interval=self.config.get("event_flush_interval", 5.0),
+            batch_size=self.config.get("event_batch_size", 500),
+        )
+        self.events.start()
+        self.rewards = RewardReconciler(
+            self,
+            interval=self.config.get("reward_interval", 10.0),
+            budget=self.config.get("reward_budget", 10),
+        )
+        self.rewards.start()
+        postgres = self.config.get("storage") != "memory"
+        self.tasks = TaskSupervisor(
+            self,
+            concurrency=self.config.get("task_concurrency", 8),
+            max_queue=self.config.get("task_queue", 1000),
+            pool_size=(self.config.credentials or {}).get("max_size", 10) if postgres else None,
+        )
+        self.tasks.start()
+        self.errors = ErrorAggregator(window=self.config.get("error_window", 300.0))
+
+        self.loop.create_task(self.warm_up())
+        if self.config.get("metrics_port"):
+            self.loop.create_task(self.start_metrics())
+
+    async def start_metrics(self):
+        self.metrics_server = await start_http_server(self.config.get("metrics_host", "127.0.0.1"),
+                                                      self.config["metrics_port"])
+
+    async def warm_up(self):
+        """Connect to storage and let every cog hydrate its caches, then release the held back events."""
+        try:
+            await self.acquire_pool()
+            for cog in list(self.cogs.values()):
+                warm_up = getattr(cog, "cog_warm_up", None)
+                if warm_up is not None:
+                    await warm_up()
+        except Exception:
+            self.logger.critical("Failed to warm up, messages stay held back.", exc_info=True)
+            raise
+
+        self.warmed_up.set()
+        self.logger.info(f"Warmed up, replaying {len(self._warm_up_buffer)} events received meanwhile.")
+        while self._warm_up_buffer:
+            event_name, args, kwargs = self._warm_up_buffer.popleft()
+            super().dispatch(event_name, *args, **kwargs)
 
-        self.loop.create_task(self.acquire_pool())
+    def dispatch(self, event_name, *args, **kwargs):
+        if event_name in WARM_UP_EVENTS and not self.warmed_up.is_set():
+            if len(self._warm_up_buffer) == self._warm_up_buffer.maxlen:
+                WARM_UP_OVERFLOW.inc()
+                self.logger.warning("Warm-up buffer is full, discarding the oldest held back event.")
+            self._warm_up_buffer.append((event_name, args, kwargs))
+            return
+        super().dispatch(event_name, *args, **kwargs)
 
     async def acquire_pool(self):
-        credentials = self.config.pop("database")
+        if self.config.get("storage") == "memory":
+            self.logger.warning("Using in-memory storage, nothing will be persisted.")
+            self.storage = MemoryStorage()
+            self.db_available.set()
+            return
+
+        credentials = self.config.credentials
 
         if not credentials:
             self.logger.critical("Cannot connect to db, no credentials!")
             await self.logout()
+            return
+
+        # migrate over a throwaway connection first, so the pool only ever sees the current schema
+        migration_pool = await asyncpg.create_pool(**dict(credentials, min_size=1, max_size=1))
+        try:
+            await apply_migrations(migration_pool, logger=self.logger)
+        finally:
+            await migration_pool.close()
 
-        self.db = await asyncpg.create_pool(**credentials)
+        self.db = TimedPool(await create_pool(dict(credentials)))
+        self.storage = PostgresStorage(self.db, notify=self.config.get("cache_sync", "shard_ids" in self.config))
+        self.storage_listener = self.loop.create_task(self.storage.listen(self.on_storage_notification))
         self.db_available.set()
 
+    def on_storage_notification(self, event, data):
+        self.dispatch("storage_event", event, data)
+
+    def refresh_granted_guilds(self):
+        channels = map(self.get_channel, self.config.drop_channels)
+        self.granted_guilds = frozenset(channel.guild.id for channel in channels if channel is not None)
+
+    def reload_config(self):
+        """Load the config file again and swap it in. Returns the changed keys, and those that need a restart."""
+        config = Config.load(self.config_path)
+        changed = self.config.changed_keys(config)
+        self.config = config
+        self.refresh_granted_guilds()
+        self.logger.info(f"Reloaded config from {self.config_path}, changed: {', '.join(changed) or 'nothing'}")
+        return changed, [key for key in changed if key in RESTART_KEYS]
+
+    async def on_ready(self):
+        self.refresh_granted_guilds()
+
     async def on_command_error(self, ctx: commands.Context, exception):
         msg = ctx.message
         if isinstance(exception, (commands.CommandOnCooldown, commands.CommandNotFound,
@@ -50,10 +177,31 @@ class DropBot(commands.Bot):
                                                               exception.__traceback__, 8))
             error_hash = hashlib.sha256(error_digest.encode("utf8")).hexdigest()
             short_hash = error_hash[0:8]
-            self.logger.error(f"Encountered command error [{error_hash}] ({msg.id}):\n{error_digest}")
+            context = {"command": ctx.command.qualified_name if ctx.command else None, "message_id": msg.id,
+                       "channel_id": msg.channel.id, "author_id": msg.author.id}
+            suppressed = self.errors.record(error_hash, error_digest, context)
+            if suppressed is None:
+                return  # already reported within the window, the aggregator keeps count
+
+            repeats = f", {suppressed} more since the last report" if suppressed else ""
+            self.logger.error(f"Encountered command error [{error_hash}] ({msg.id}{repeats}):\n{error_digest}")
             await ctx.send(f"Uh-oh, that's an error [{short_hash}...]")
 
+    async def close(self):
+        # let queued drops and scores finish while storage and the outbox are still up
+        await self.tasks.close()
+        self.rewards.stop()
+        await self.outbox.close()
+        if self.storage_listener is not None:
+            self.storage_listener.cancel()
+        await self.events.close()
+        if self.storage is not None:
+            await self.storage.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+        await super().close()
+
     async def is_owner(self, user):
-        if user.id in self.config.get("admin_users", []):
+        if user.id in self.config.admin_users:
             return True
         return await super().is_owner(user)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Leaderboard and Santa's List cards rendered with Pillow.
+
+The render functions only take tuples and return PNG bytes, so ``CardCache`` can run them on an
+executor thread while the event loop carries on. Running this module benchmarks them:
+
+    python cards.py --participants 10000
+"""
+import argparse
+import asyncio
+import functools
+import io
+import random
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+from metrics import Counter, Histogram
+
+
+BACKGROUND = (47, 49, 54)
+TEXT = (220, 221, 222)
+MUTED = (142, 146, 151)
+LEADERBOARD_ACCENT = (255, 0, 0)
+ROSTER_ACCENT = (105, 224, 165)
+
+PADDING = 16
+NICKNAME_CHARS = 24
+LEADERBOARD_WIDTH = 480
+ROSTER_COLUMNS = 4
+ROSTER_ROWS = 60
+ROSTER_COLUMN_WIDTH = 260
+# Discord takes at most this many attachments per message
+CARDS_PER_MESSAGE = 10
+
+CARD_RENDER_SECONDS = Histogram("dropbot_card_render_seconds", "Time spent rendering cards", ["card"])
+CARD_REQUESTS = Counter("dropbot_card_requests_total", "Card requests by whether a cached render was reused",
+                        ["card", "result"])
+
+
+class Glyphs:
+    """A font's glyphs rendered once each and stamped from then on.
+
+    Pillow shapes and rasterises the whole string on every ``text`` call, which dominates a card
+    with thousands of short lines. Nicknames reuse a small set of characters, so masks for them are
+    cached and drawn with ``bitmap``, kerning is ignored.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.bitmap_only = not isinstance(font, ImageFont.FreeTypeFont)
+        _, top, _, bottom = font.getbbox("Ag")
+        self.line_height = bottom - top + 6
+        self._glyphs = {}
+
+    def _glyph(self, char):
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            left, top, right, bottom = self.font.getbbox(char)
+            mask = None
+            if right > left and bottom > top:
+                mask = Image.new("L", (right - left, bottom - top))
+                ImageDraw.Draw(mask).text((-left, -top), char, font=self.font, fill=255)
+            glyph = self._glyphs[char] = (mask, left, top, self.font.getlength(char))
+        return glyph
+
+    def clip(self, text, chars=NICKNAME_CHARS):
+        if len(text) > chars:
+            text = text[:chars - 3] + "..."
+        if self.bitmap_only:
+            # the bitmap font only covers latin-1 and raises on anything else
+            text = text.encode("latin-1", "replace").decode("latin-1")
+        return text
+
+    def draw(self, draw, xy, text, fill):
+        x, y = xy
+        for char in text:
+            mask, left, top, advance = self._glyph(char)
+            if mask is not None:
+                draw.bitmap((round(x + left), y + top), mask, fill=fill)
+            x += advance
+
+
+@functools.lru_cache(maxsize=None)
+def load_glyphs(path=None, size=16):
+    """Glyphs of the TrueType font at ``path``, or of Pillow's built-in font when there is none."""
+    if path:
+        return Glyphs(ImageFont.truetype(path, size))
+    try:
+        return Glyphs(ImageFont.load_default(size))
+    except TypeError:
+        # before Pillow 10.1 the built-in font is a fixed size bitmap
+        return Glyphs(ImageFont.load_default())
+
+
+def encode(image):
+    # a few colours and their antialiasing are all a card has, a 32 colour palette keeps the PNG
+    # about a quarter of the size and quicker to compress than the RGB original
+    buffer = io.BytesIO()
+    image.quantize(32, method=Image.Quantize.FASTOCTREE).save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def render_leaderboard(rows, title, font_path=None, font_size=16):
+    """One card ranking ``(nickname, gifts)`` rows from first to last."""
+    glyphs = load_glyphs(font_path, font_size)
+    line = glyphs.line_height
+    header = line * 2
+
+    image = Image.new("RGB", (LEADERBOARD_WIDTH, PADDING * 2 + header + line * max(len(rows), 1)), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 4, image.height), fill=LEADERBOARD_ACCENT)
+    glyphs.draw(draw, (PADDING, PADDING), glyphs.clip(title, 60), LEADERBOARD_ACCENT)
+
+    y = PADDING + header
+    if not rows:
+        glyphs.draw(draw, (PADDING, y), "Nobody has any gifts yet.", MUTED)
+    for rank, (nickname, gifts) in enumerate(rows, 1):
+        glyphs.draw(draw, (PADDING, y), f"{rank}.", MUTED)
+        glyphs.draw(draw, (PADDING + font_size * 3, y), glyphs.clip(nickname), TEXT)
+        glyphs.draw(draw, (LEADERBOARD_WIDTH - PADDING - font_size * 4, y), str(gifts), TEXT)
+        y += line
+    return encode(image)
+
+
+def render_roster(rows, title, font_path=None, font_size=16):
+    """Cards listing ``(nickname, gifts_sent, gifts_received)`` rows in columns, one per page of rows."""
+    glyphs = load_glyphs(font_path, font_size)
+    line = glyphs.line_height
+    header = line * 2
+    per_card = ROSTER_COLUMNS * ROSTER_ROWS
+    pages = [rows[start:start + per_card] for start in range(0, len(rows), per_card)] or [[]]
+
+    cards = []
+    for number, page in enumerate(pages, 1):
+        # fill the columns top to bottom, only as tall as this page needs
+        column_rows = max(-(-len(page) // ROSTER_COLUMNS), 1)
+        image = Image.new("RGB", (PADDING * 2 + ROSTER_COLUMN_WIDTH * ROSTER_COLUMNS,
+                                  PADDING * 2 + header + line * column_rows), BACKGROUND)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, 4, image.height), fill=ROSTER_ACCENT)
+
+        heading = title if len(pages) == 1 else f"{title} (page {number}/{len(pages)})"
+        glyphs.draw(draw, (PADDING, PADDING), glyphs.clip(heading, 80), ROSTER_ACCENT)
+
+        for index, (nickname, given, received) in enumerate(page):
+            column, row = divmod(index, column_rows)
+            glyphs.draw(draw, (PADDING + column * ROSTER_COLUMN_WIDTH, PADDING + header + row * line),
+                        f"{glyphs.clip(nickname, 18)} ({given}:{received})", TEXT)
+        cards.append(encode(image))
+    return cards
+
+
+class CardCache:
+    """Renders cards on a small thread pool and keeps them until the state they show changes.
+
+    ``get`` reuses the card cached under a key until ``invalidate`` is called, requests that arrive
+    while it is still rendering wait on the same render. Only on a miss is ``snapshot`` called, on
+    the event loop, to copy the state into plain rows for the render thread.
+    """
+
+    def __init__(self, workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cards")
+        self._cards = {}
+        self.version = 0
+
+    def invalidate(self):
+        self.version += 1
+        self._cards.clear()
+
+    def _timed(self, render, *args):
+        with CARD_RENDER_SECONDS.time(card=render.__name__):
+            return render(*args)
+
+    async def render(self, render, *args):
+        """Run ``render(*args)`` on the pool without caching the result."""
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, functools.partial(self._timed, render, *args))
+
+    async def get(self, key, render, snapshot, *args):
+        future = self._cards.get(key)
+        if future is None:
+            CARD_REQUESTS.inc(card=render.__name__, result="rendered")
+            future = self._cards[key] = asyncio.ensure_future(self.render(render, snapshot(), *args))
+        else:
+            CARD_REQUESTS.inc(card=render.__name__, result="cached")
+
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # don't keep serving a failed render
+            if self._cards.get(key) is future:
+                del self._cards[key]
+            raise
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def benchmark(participants, font_path=None, font_size=16, repeat=3):
+    names = ["".join(random.choices(string.ascii_letters, k=random.randint(2, 32))) for _ in range(participants)]
+    rows = sorted(((name, random.randint(0, 50), random.randint(0, 50)) for name in names),
+                  key=lambda row: row[0].casefold())
+    top = sorted(((name, sent) for name, sent, _ in rows), key=lambda row: -row[1])[:25]
+
+    for name, render, args in (("leaderboard (top 25)", render_leaderboard, (top, "Gifts sent")),
+                               (f"roster ({participants})", render_roster, (rows, "Blob Santa's List"))):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = render(*args, font_path=font_path, font_size=font_size)
+            timings.append(time.perf_counter() - start)
+        cards = result if isinstance(result, list) else [result]
+        print(f"{name}: best {min(timings) * 1000:.1f} ms, mean {sum(timings) / repeat * 1000:.1f} ms, "
+              f"{len(cards)} cards, {sum(map(len, cards)) / 1024:.0f} KiB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark card rendering.")
+    parser.add_argument("--participants", type=int, default=10000)
+    parser.add_argument("--font", default=None, help="TrueType font to render with")
+    parser.add_argument("--font-size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    benchmark(args.participants, args.font, args.font_size, args.repeat)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+from discord.ext import commands
+
+from events import export_events
+from metrics import REGISTRY
+from outbound import MESSAGE_LIMIT, chunk_lines
+from roster import export_roster, parse_roster
+
+
+# room for the code block fences wrapped around each chunk
+CODE_BLOCK_LIMIT = MESSAGE_LIMIT - len("```\n\n```")
+
+
+class Admin(commands.Cog):
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+
+    async def cog_check(self, ctx: commands.Context):
+        return await self.bot.is_owner(ctx.author)
+
+    @commands.command("metrics")
+    async def metrics_command(self, ctx: commands.Context, *, prefix: str = 'dropbot_'):
+        """Dump a snapshot of the bot's metrics"""
+        lines = [line for line in REGISTRY.snapshot() if line.startswith(prefix)]
+        if not lines:
+            await ctx.send("No metrics recorded yet.")
+            return
+
+        for chunk in chunk_lines(lines, CODE_BLOCK_LIMIT):
+            await ctx.send(f"```\n{chunk}\n```")
+
+    @commands.command("outbox")
+    async def outbox_command(self, ctx: commands.Context):
+        """Show outbound queue depth and latency"""
+        lines = [f"{name}: {stats['depth']} queued, {stats['sent']} sent, {stats['failed']} failed, "
+                 f"{stats['mean_latency']:.3f}s mean / {stats['max_latency']:.3f}s max latency"
+                 for name, stats in self.bot.outbox.stats().items()]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.command("errors")
+    async def errors_command(self, ctx: commands.Context, error_hash: str = None):
+        """List the most frequent command errors, or show one's traceback"""
+        if error_hash is not None:
+            entry = self.bot.errors.get(error_hash)
+            if entry is None:
+                await ctx.send(f"No error matching [{error_hash}] is tracked.")
+                return
+            context = ", ".join(f"{key}={value}" for key, value in entry.context.items())
+            await ctx.send(f"[{entry.error_hash[:8]}...] seen {entry.count} times, first with {context}")
+            for chunk in chunk_lines(entry.digest.splitlines(), CODE_BLOCK_LIMIT):
+                await ctx.send(f"```\n{chunk}\n```")
+            return
+
+        entries = self.bot.errors.top()
+        if not entries:
+            await ctx.send("No command errors recorded.")
+            return
+
+        lines = [f"[{entry.error_hash[:8]}] {entry.count}x in {entry.context['command']}, "
+                 f"first {datetime.utcfromtimestamp(entry.first_seen):%Y-%m-%d %H:%M}, "
+                 f"last {datetime.utcfromtimestamp(entry.last_seen):%Y-%m-%d %H:%M}: {entry.summary}"
+                 for entry in entries]
+        for chunk in chunk_lines(lines, CODE_BLOCK_LIMIT):
+            await ctx.send(f"```\n{chunk}\n```")
+
+    @commands.command("reload_config")
+    async def reload_config_command(self, ctx: commands.Context):
+        """Reload config.toml without restarting"""
+        try:
+            changed, needs_restart = self.bot.reload_config()
+        except (OSError, ValueError) as exception:
+            await ctx.send(f"Kept the current config, the new one failed to load: {exception}")
+            return
+
+        message = f"Reloaded config, changed: {', '.join(changed) or 'nothing'}."
+        if needs_restart:
+            message += f" These only take effect after a restart: {', '.join(needs_restart)}."
+        await ctx.send(message)
+
+    @commands.command("export_events")
+    async def export_events_command(self, ctx: commands.Context, days: float = None):
+        """Export the gift event log to CSV, optionally only the last few days"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        since = datetime.utcnow() - timedelta(days=days) if days is not None else None
+        await self.bot.events.flush()
+        path, rows = await export_events(self.bot.storage, since=since)
+        await ctx.send(f"Exported {rows} gift events to `{path}`.")
+
+    @commands.command("import_roster")
+    async def import_roster_command(self, ctx: commands.Context):
+        """Bulk add participants from an attached roster CSV"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+        if not ctx.message.attachments:
+            await ctx.send("Attach a CSV with user_id and nickname columns.")
+            return
+
+        content = await ctx.message.attachments[0].read()
+        try:
+            records = parse_roster(content.decode("utf-8-sig").splitlines())
+        except (UnicodeDecodeError, ValueError) as exception:
+            await ctx.send(f"Could not read the roster: {exception}")
+            return
+
+        inserted = await self.bot.storage.import_participants(records)
+        await self.bot.get_cog("CoinDrop").add_participants(inserted)
+        await ctx.send(f"Imported {len(inserted)} of {len(records)} participants, "
+                       f"{len(records) - len(inserted)} skipped because the id or nickname was taken.")
+
+    @commands.command("export_roster")
+    async def export_roster_command(self, ctx: commands.Context):
+        """Export user_data and gifts to CSV"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        exported = await export_roster(self.bot.storage)
+        await ctx.send("\n".join(f"Exported {rows} rows to `{path}`." for path, rows in exported))
+
+    @commands.command("reset_users")
+    async def reset_users_command(self, ctx: commands.Context, *user_ids: int):
+        """Reset several users' accounts after one confirmation"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+        user_ids = set(user_ids)
+        if not user_ids:
+            await ctx.send("Give the ids of the users to reset.")
+            return
+
+        confirm_text = f"confirm {random.randint(0, 999999):06}"
+        await ctx.send(f"Are you sure? This deletes {len(user_ids)} users and their gifts. "
+                       f"(type '{confirm_text}' or 'cancel')")
+
+        def wait_check(msg):
+            return msg.author.id == ctx.author.id and msg.content.lower() in (confirm_text, "cancel")
+
+        try:
+            validate_message = await self.bot.wait_for('message', check=wait_check, timeout=30)
+        except asyncio.TimeoutError:
+            await ctx.send(f"Timed out request to reset {len(user_ids)} users.")
+            return
+        if validate_message.content.lower() == 'cancel':
+            await ctx.send("Cancelled.")
+            return
+
+        deleted = await self.bot.storage.delete_participant_ids(user_ids)
+        await self.bot.get_cog("CoinDrop").remove_participant_ids(deleted)
+        for user_id in deleted:
+            self.bot.events.record("reset", user_id)
+        await ctx.send(f"Cleared {len(deleted)} entries, {len(user_ids) - len(deleted)} ids had none.")
+
+
+def setup(bot):
+    bot.add_cog(Admin(bot))
@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import io
 import random
+import time
 from datetime import datetime
 
 import discord
 from discord.ext import commands
 
-from tools import test_username, check_has_gift, secret_string_wrapper
+from cards import CARDS_PER_MESSAGE, CardCache, render_leaderboard, render_roster
+from metrics import Counter, Gauge, Histogram
+from outbound import PRIORITY_DM
+from storage import StorageConflict
+from tools import test_username, check_has_gift, puzzle_hint
 from . import utils
+from .state import CooldownTable, DropGate, DropScheduler, GiftIndex, Leaderboard, PuzzlePool, RosterSampler
 
 
-class Rollback(Exception):
-    pass
+ON_MESSAGE_SECONDS = Histogram("dropbot_on_message_seconds", "Time spent in CoinDrop.on_message", ["source"])
+CREATE_GIFT_SECONDS = Histogram("dropbot_create_gift_seconds", "Time spent in CoinDrop.create_gift")
+SCORE_SECONDS = Histogram("dropbot_score_seconds", "Time spent settling scores", ["phase"])
+DROPS = Counter("dropbot_drops_total", "Gift labels sent to users", ["attempt"])
+DROPS_SKIPPED = Counter("dropbot_drops_skipped_total", "Drops turned away by the scheduler or drop gate", ["reason"])
+DROPS_IN_FLIGHT = Gauge("dropbot_drops_in_flight", "Drops currently being created")
+GUESSES = Counter("dropbot_guesses_total", "Label guesses received in DMs", ["result"])
+SOLVE_SECONDS = Histogram("dropbot_solve_seconds", "Time between a label being sent and it being solved",
+                          buckets=(5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400))
 
 
 class CoinDrop(commands.Cog):
@@ -20,183 +34,330 @@ class CoinDrop(commands.Cog):
         self.http = None
         self.session = None
         self.bot = bot
-        self.drop_lock = asyncio.Lock()
+        self.scheduler = DropScheduler()
+        self.drop_gate = DropGate(self.bot.config.get("max_concurrent_drops", 8))
+        DROPS_IN_FLIGHT.set_function(lambda: len(self.drop_gate))
         self.acquire_lock = asyncio.Lock()
-        self.current_gifters = []
+        self.current_gifters = set()
+        self.gift_index = GiftIndex()
+        self.roster = RosterSampler()
+        self.cooldowns = CooldownTable()
+        self.leaderboard = Leaderboard()
+        self.puzzles = PuzzlePool(self.bot.config.get("puzzle_pool_size", 12))
+        self.cards = CardCache(self.bot.config.get("render_workers", 1))
+        self.load_lock = asyncio.Lock()
+        # changes made while a resync queries storage, reapplied to the rebuilt state
+        self._replay = None
+
+        # at startup the bot calls cog_warm_up itself and holds messages back until it returns
+        if self.bot.warmed_up.is_set():
+            self.bot.loop.create_task(self.load_state())
+
+    async def cog_warm_up(self):
+        await self.load_state()
+
+    def cog_unload(self):
+        self.cards.close()
+
+    async def load_state(self, replace=False):
+        """Fill the caches from storage.
+
+        The first load merges, so drops that committed while the queries ran are kept. With
+        ``replace`` the caches are rebuilt from the results and swapped in, which drops participants
+        and gifts removed elsewhere, and the changes made here meanwhile are applied again on top.
+        """
+        await self.bot.db_available.wait()
+
+        async with self.load_lock:
+            if replace:
+                self._replay = []
+            try:
+                participants = await self.bot.storage.load_participants()
+                records = await self.bot.storage.load_active_gifts()
+            except BaseException:
+                self._replay = None
+                raise
+
+            if replace:
+                self.gift_index, self.roster, self.cooldowns = GiftIndex(), RosterSampler(), CooldownTable()
+                self.leaderboard, self.current_gifters = Leaderboard(), set()
+
+            self.gift_index.load(records)
+            self.current_gifters.update(record['user_id'] for record in records)
+            self.roster.load(participants)
+            self.cooldowns.load(participants)
+            self.leaderboard.load(participants)
+
+            if replace:
+                replay, self._replay = self._replay, None
+                self.puzzles.forget(lambda user_id: user_id not in self.roster)
+                for method, args in replay:
+                    method(*args)
+            self.cards.invalidate()
+
+        await self.load_puzzles(participants)
+        # catch up on roles missed while the bot was down or the thresholds were changed
+        for record in participants:
+            self.bot.rewards.note(record['user_id'], record['gifts_sent'], record['gifts_received'])
+        self.bot.logger.info(f"Loaded {len(self.roster)} participants and {len(self.current_gifters)} active gifts.")
+
+    async def load_puzzles(self, participants, chunk=500):
+        # generating puzzles for a large roster takes a while, let messages through in between
+        for start in range(0, len(participants), chunk):
+            self.puzzles.load(participants[start:start + chunk])
+            await asyncio.sleep(0)
+
+    def _record_for_replay(self, method, *args):
+        if self._replay is not None:
+            self._replay.append((method, args))
+
+    def track_participant(self, record, puzzles=True):
+        self._record_for_replay(self.track_participant, record)
+        self.roster.add(record['user_id'], record['nickname'], record['gifts_received'])
+        if puzzles:
+            self.puzzles.add(record['user_id'], record['nickname'])
+        self.cooldowns.set(record['user_id'], record['last_gift'])
+        self.leaderboard.update(record['user_id'], record['gifts_sent'], record['gifts_received'])
+        self.cards.invalidate()
+
+    def forget_users(self, predicate):
+        self._record_for_replay(self.forget_users, predicate)
+        self.roster.forget(predicate)
+        self.cooldowns.forget(predicate)
+        self.leaderboard.forget(predicate)
+        self.puzzles.forget(predicate)
+        self.cards.invalidate()
+        self.bot.rewards.forget(predicate)
+        self.current_gifters.difference_update(self.gift_index.forget(predicate))
+
+    async def add_participant(self, record):
+        self.track_participant(record)
+        await self.bot.storage.publish("join", dict(record))
+
+    async def remove_participants(self, low, high):
+        self.forget_users(lambda user_id: low <= user_id < high)
+        await self.bot.storage.publish("forget", {'low': low, 'high': high})
+
+    async def add_participants(self, records):
+        records = list(records)
+        for record in records:
+            self.track_participant(record, puzzles=False)
+        await self.load_puzzles(records)
+        # cheaper for the other processes to reload than to receive thousands of joins
+        await self.bot.storage.publish("resync", {})
+
+    async def remove_participant_ids(self, user_ids):
+        user_ids = list(user_ids)
+        self.forget_users(set(user_ids).__contains__)
+        await self.bot.storage.publish_forget_ids(user_ids)
+
+    def forget_gift(self, user_id):
+        """Drop ``user_id``'s active gift from the cache, returning it if there was one."""
+        self._record_for_replay(self.forget_gift, user_id)
+        self.current_gifters.discard(user_id)
+        return self.gift_index.pop(user_id)
+
+    def apply_gift(self, user_id, target_user_id, nickname, issued_at):
+        self._record_for_replay(self.apply_gift, user_id, target_user_id, nickname, issued_at)
+        self.gift_index.set(user_id, target_user_id, nickname, issued_at)
+        self.current_gifters.add(user_id)
+        self.cooldowns.set(user_id, issued_at)
+
+    def apply_scores(self, records, solves):
+        self._record_for_replay(self.apply_scores, records, solves)
+        for record in records:
+            self.gift_index.pop(record['user_id'])
+            self.current_gifters.discard(record['user_id'])
+            self.roster.add_received(record['target_user_id'])
+            self.cooldowns.set(record['user_id'], solves[record['user_id']])
+            self.leaderboard.update(record['user_id'], record['gifts_sent'], record['gifts_received'])
+            self.leaderboard.update(record['target_user_id'], record['target_gifts_sent'],
+                                    record['target_gifts_received'])
+            self.bot.rewards.note(record['user_id'], record['gifts_sent'], record['gifts_received'])
+            self.bot.rewards.note(record['target_user_id'], record['target_gifts_sent'],
+                                  record['target_gifts_received'])
+        if records:
+            self.cards.invalidate()
+
+    @commands.Cog.listener()
+    async def on_storage_event(self, event, data):
+        """Apply changes made by the bot processes running the other shards."""
+        if event == "gift":
+            self.apply_gift(data['user_id'], data['target_user_id'], data['nickname'],
+                            datetime.fromisoformat(data['issued_at']))
+        elif event == "score":
+            solves = {data['user_id']: datetime.fromisoformat(data['solved_at'])}
+            self.apply_scores([data], solves)
+        elif event == "giveup":
+            self.forget_gift(data['user_id'])
+        elif event == "join":
+            self.track_participant(dict(data, last_gift=datetime.fromisoformat(data['last_gift'])))
+        elif event == "forget":
+            self.forget_users(lambda user_id: data['low'] <= user_id < data['high'])
+        elif event == "forget_ids":
+            self.forget_users(set(data['user_ids']).__contains__)
+        elif event == "resync":
+            await self.load_state(replace=True)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        with ON_MESSAGE_SECONDS.time(source="channel" if message.guild else "dm"):
+            await self.handle_message(message)
+
+    async def handle_message(self, message: discord.Message):
 
         immediate_time = datetime.utcnow()
         if message.author.id in self.current_gifters and not message.guild:
-            async with self.bot.db.acquire() as conn:
-                last_gift = await conn.fetchval("SELECT last_gift FROM user_data WHERE user_id = $1", message.author.id)
-
-                gift = await conn.fetchrow(
-                    """
-                    SELECT nickname
-                    FROM gifts 
-                    INNER JOIN user_data
-                    ON target_user_id = user_data.user_id
-                    WHERE gifts.user_id = $1 AND active 
-                    """, message.author.id)
-                if message.content.lower().strip().replace(' ', '') == gift['nickname'].lower().strip().replace(' ', ''):
-                    self.current_gifters.remove(message.author.id)
-                    self.bot.loop.create_task(self.add_score(message.author, message.created_at))
-                    self.bot.logger.info(f"User {message.author.id} guessed gift ({gift['nickname']}) in "
-                                     f"{(immediate_time - last_gift).total_seconds()} seconds.")
+            gift = self.gift_index.check(message.author.id, message.content)
+            if gift is not None:
+                solve_time = (immediate_time - gift.issued_at).total_seconds()
+                GUESSES.inc(result="correct")
+                SOLVE_SECONDS.observe(solve_time)
+                self.forget_gift(message.author.id)
+                self.bot.tasks.submit("add_score", self.add_score(message.author, message.created_at, solve_time))
+                self.bot.logger.info(f"User {message.author.id} guessed gift ({gift.answer}) in "
+                                     f"{solve_time} seconds.",
+                                     extra={"event": {"event": "solve", "user_id": message.author.id,
+                                                      "target_user_id": gift.target_user_id,
+                                                      "solve_seconds": solve_time}})
+            else:
+                GUESSES.inc(result="wrong")
             return
 
-
         if message.content.startswith("."):
             return  # do not drop coins on commands
 
-        if message.channel.id not in self.bot.config.get("drop_channels", []):
-            return
-
-        if self.drop_lock.locked():
+        if message.channel.id not in self.bot.config.drop_channels:
             return
 
         # Ignore messages that are more likely to be spammy
         if len(message.content) < 5:
             return
-        drop_chance = self.bot.config.get("drop_chance", 0.1)
-        if random.random() < drop_chance:
-            async with self.bot.db.acquire() as conn:
-                record = await conn.fetchrow("SELECT last_gift FROM user_data WHERE user_id = $1", message.author.id)
-                if record is not None:
-                    if (datetime.utcnow() - record['last_gift']).total_seconds() > self.bot.config.get("cooldown_time", 30):
-                        self.bot.logger.info(f"A natural gift has dropped ({message.author.id})")
+        config = self.bot.config
+        channel_id = message.channel.id
+        if not self.scheduler.has_token(channel_id, time.monotonic(), config.drop_rate(channel_id), config.drop_burst):
+            return
+        if not self.scheduler.allows(channel_id, message.author.id, config.drop_burst):
+            DROPS_SKIPPED.inc(reason="fairness")
+            return
+        if not self.cooldowns.ready(message.author.id, immediate_time, config.cooldown_time):
+            return
+        if not self.drop_gate.try_acquire(message.author.id):
+            DROPS_SKIPPED.inc(reason="user" if message.author.id in self.drop_gate else "capacity")
+            self.bot.logger.debug(f"Skipped a natural gift for {message.author.id}, drops are saturated "
+                                  f"({dict(self.drop_gate.skipped)}).")
+            return
 
-                        self.bot.loop.create_task(self.create_gift(message.author, message.created_at))
+        # the gate already bounds queued drops, so this only refuses while shutting down or when
+        # task_queue is set below max_concurrent_drops
+        if not self.bot.tasks.submit("create_gift", self.create_gift(message.author, message.created_at),
+                                     droppable=True):
+            self.drop_gate.release(message.author.id)
+            DROPS_SKIPPED.inc(reason="backlog")
+            return
 
-    async def perform_natural_drop(self, user, secret_member, first_attempt):
-        async with self.drop_lock:
-            secret_string = secret_string_wrapper(secret_member)
-            
-            gift_colors = self.bot.config.get('gift_colors')
+        # claim the cooldown now, create_gift writes it through to last_gift
+        self.scheduler.grant(channel_id, message.author.id, config.drop_burst, config.drop_fairness)
+        self.cooldowns.set(message.author.id, message.created_at)
+        self.bot.logger.info(f"A natural gift has dropped ({message.author.id})",
+                             extra={"event": {"event": "drop", "user_id": message.author.id,
+                                              "channel_id": channel_id}})
 
-            new_present = "You found a {0} present with a {1} ribbon!".format(random.choice(gift_colors), random.choice(gift_colors))
-            try_again = random.choice(self.bot.config.get('try_again'))
+    async def perform_natural_drop(self, user, target_user_id, secret_member, first_attempt):
+        puzzle = self.puzzles.pick(user.id, target_user_id, secret_member, self.bot.config.puzzle_difficulty,
+                                   fresh=first_attempt)
+        secret_string = puzzle_hint(puzzle)
 
-            drop_string = "{0} {1} Fix the label and send the gift by typing the proper label.".format(
-                new_present if first_attempt else try_again,
-                secret_string
-            )                
+        gift_colors = self.bot.config.get('gift_colors')
 
-            await user.send(drop_string)
+        new_present = "You found a {0} present with a {1} ribbon!".format(random.choice(gift_colors), random.choice(gift_colors))
+        try_again = random.choice(self.bot.config.get('try_again'))
 
-    async def create_gift(self, member, when):
-        async with self.bot.db.acquire() as conn:
-
-            secret_member_obj = {}
-            first_attempt = True
-
-            ret_value = await conn.fetchrow(
-                """
-                SELECT nickname, user_data.user_id
-                FROM gifts
-                INNER JOIN user_data
-                ON target_user_id = user_data.user_id
-                WHERE gifts.user_id = $1 AND active 
-                """,
-                member.id
-            )
-            if member.id not in self.current_gifters:
-                self.current_gifters.append(member.id)
-            if ret_value is not None:
-                first_attempt = False
-                secret_member_obj = ret_value
-            else:
-                ret_value = await conn.fetch("SELECT nickname, user_id FROM user_data WHERE user_id != $1", member.id)
-                secret_members = [x for x in ret_value]
-                self.bot.logger.info(secret_members)
-                if not secret_members:
-                    self.bot.logger.error(f"I wanted to drop a gift, but I couldn't find any members to send to!")
-                    return
-                secret_member_obj = random.choice(secret_members)
+        drop_string = "{0} {1} Fix the label and send the gift by typing the proper label.".format(
+            new_present if first_attempt else try_again,
+            secret_string
+        )
 
-            secret_member = secret_member_obj['nickname']
-            target_user_id = secret_member_obj['user_id']
+        self.bot.outbox.send(user, drop_string, priority=PRIORITY_DM)
 
+    async def create_gift(self, member, when):
+        try:
+            with CREATE_GIFT_SECONDS.time():
+                await self._create_gift(member, when)
+        finally:
+            self.drop_gate.release(member.id)
+
+    async def _create_gift(self, member, when):
+        first_attempt = True
+        secret_member_obj = await self.bot.storage.get_active_gift(member.id)
+        if secret_member_obj is not None:
+            first_attempt = False
+        else:
+            target_user_id = self.roster.sample(member.id, weighted=self.bot.config.balance_targets)
+            if target_user_id is None:
+                self.bot.logger.error(f"I wanted to drop a gift, but I couldn't find any members to send to!")
+                return
+            secret_member_obj = {'nickname': self.roster.nickname(target_user_id), 'user_id': target_user_id}
 
-            async with conn.transaction():
-                await conn.fetch(
-                    """
-                    UPDATE user_data 
-                    SET last_gift = $2
-                    WHERE user_id = $1
-                    """,
-                    member.id,
-                    when
-                )
-                if first_attempt:
-                    await conn.fetch(
-                        """
-                        INSERT INTO gifts (user_id, target_user_id)
-                            VALUES ($1, $2)
-                        """,
-                        member.id,
-                        target_user_id
-                    )
-        await self.perform_natural_drop(member, secret_member, first_attempt)
+        secret_member = secret_member_obj['nickname']
+        target_user_id = secret_member_obj['user_id']
 
-    async def _add_score(self, user_id, when):
+        if not await self.bot.storage.create_gift(member.id, target_user_id, when, first_attempt):
+            self.bot.logger.warning(f"User {member.id} already has an active gift, not dropping another.")
+            return
+        self.apply_gift(member.id, target_user_id, secret_member, when)
+        DROPS.inc(attempt="first" if first_attempt else "retry")
+        self.bot.events.record("drop" if first_attempt else "retry", member.id, target_user_id, when)
+        await self.perform_natural_drop(member, target_user_id, secret_member, first_attempt)
+        await self.bot.storage.publish("gift", {'user_id': member.id, 'target_user_id': target_user_id,
+                                                'nickname': secret_member, 'issued_at': when})
+
+    async def _add_scores(self, solves):
+        """Settle a batch of (user_id, when) correct guesses in a single statement.
+
+        Returns one record per settled gift with the sender's new totals and the target's nickname.
+        Senders without an active gift are skipped.
+        """
         await self.bot.db_available.wait()
 
-        async with self.bot.db.acquire() as conn:
-            async with conn.transaction():
-                gift = await conn.fetchrow(
-                    """
-                    UPDATE gifts
-                    SET active = FALSE
-                    WHERE user_id = $1 AND active = TRUE
-                    RETURNING target_user_id 
-                    """,
-                    user_id
-                )
-                target_user_nickname = await conn.fetchrow(
-                    """
-                    UPDATE user_data
-                    SET gifts_received = gifts_received + 1
-                    WHERE user_id = $1
-                    RETURNING nickname
-                    """,
-                    gift['target_user_id']
-                )
-                current_user = await conn.fetchrow(
-                    """
-                    UPDATE user_data 
-                    SET last_gift = $2, gifts_sent = gifts_sent + 1
-                    WHERE user_id = $1 
-                    RETURNING gifts_sent, gifts_received, nickname
-                    """,
-                    user_id,
-                    when
-                )
-                return current_user['nickname'], current_user['gifts_sent'], current_user['gifts_received'], target_user_nickname['nickname']
-
-    async def add_score(self, member, when):
-        user_nickname, gifts_sent, gifts_received, target_user_nickname = await self._add_score(member.id, when)
-        await member.send(f"You successfully sent the gift to {target_user_nickname}! (Total gifts sent: {gifts_sent})")
-        rewards = self.bot.config.get('reward_roles', {})
-        await self.bot.get_channel(778410033926897685).send(random.choice(self.bot.config.get("gift_strings")).format(f"**{user_nickname}**", f"**{target_user_nickname}**"))
-        
-        # TO-DO: Find a way to count gifts recieved in the reward role
-        rewards = self.bot.config.get('reward_roles', {})
-        if gifts_sent not in rewards:
-            return
+        solves = dict(solves)
+        for user_id in solves:
+            self.forget_gift(user_id)
 
-        role = member.guild.get_role(rewards[gifts_sent])
+        with SCORE_SECONDS.time(phase="settle"):
+            records = await self.bot.storage.settle_gifts(solves)
 
-        if role is None:
-            self.bot.logger.warning(f'Failed to find reward role for {gifts_sent} gifts sent.')
+        self.apply_scores(records, solves)
+        for record in records:
+            await self.bot.storage.publish("score", dict(record, solved_at=solves[record['user_id']]))
+        return records
+
+    async def _add_score(self, user_id, when):
+        records = await self._add_scores([(user_id, when)])
+        if not records:
+            return None
+        record = records[0]
+        return (record['nickname'], record['gifts_sent'], record['gifts_received'], record['target_user_id'],
+                record['target_nickname'])
+
+    async def add_score(self, member, when, solve_time=None):
+        with SCORE_SECONDS.time(phase="add_score"):
+            await self._announce_score(member, when, solve_time)
+
+    async def _announce_score(self, member, when, solve_time=None):
+        score = await self._add_score(member.id, when)
+        if score is None:
+            self.bot.logger.warning(f"User {member.id} guessed a gift that was no longer active.")
             return
+        user_nickname, gifts_sent, gifts_received, target_user_id, target_user_nickname = score
+        # only a settled gift counts as a solve, one given up or settled elsewhere meanwhile doesn't
+        self.bot.events.record("solve", member.id, target_user_id, when, solve_time)
+        self.bot.outbox.send(member, f"You successfully sent the gift to {target_user_nickname}! (Total gifts sent: {gifts_sent})",
+                             priority=PRIORITY_DM)
+        present_log = self.bot.config.present_log
+        if present_log:
+            self.bot.outbox.announce(present_log, random.choice(self.bot.config.get("gift_strings")).format(f"**{user_nickname}**", f"**{target_user_nickname}**"))
 
-        try:
-            await member.add_roles(role, reason=f'Reached {gifts_sent} gifts sent reward.')
-        except discord.HTTPException:
-            self.bot.logger.exception(f'Failed to add reward role for {gifts_sent} gifts sent to {member!r}.')
     @commands.cooldown(1, 4, commands.BucketType.user)
     @commands.cooldown(1, 1.5, commands.BucketType.channel)
     @commands.command("check")
@@ -205,24 +366,23 @@ class CoinDrop(commands.Cog):
         if not self.bot.db_available.is_set():
             return
 
-        async with self.bot.db.acquire() as conn:
-            record = await conn.fetchrow("SELECT gifts_sent, gifts_received, nickname FROM user_data WHERE user_id = $1", ctx.author.id)
+        record = await self.bot.storage.get_participant(ctx.author.id)
 
-            try:
-                if record is None:
-                    await ctx.author.send(f"You haven't sent any gifts yet! Use `.join` in a channel to join the fun!")
-                else:
-                    await ctx.author.send(f"You ({record['nickname']}) have sent {record['gifts_sent']} and received {record['gifts_received']} 🎁 **Gifts**.")
-                await ctx.message.delete()
-            except (discord.Forbidden, discord.HTTPException):
-                pass
+        try:
+            if record is None:
+                await ctx.author.send(f"You haven't sent any gifts yet! Use `.join` in a channel to join the fun!")
+            else:
+                await ctx.author.send(f"You ({record['nickname']}) have sent {record['gifts_sent']} and received {record['gifts_received']} 🎁 **Gifts**.")
+            await ctx.message.delete()
+        except (discord.Forbidden, discord.HTTPException):
+            pass
 
     @commands.command("giveup")
     async def giveup_command(self, ctx: commands.Context):
         """Give up on a label"""
         message: discord.Message = ctx.message
         if isinstance(message.channel, discord.DMChannel):
-            check = await check_has_gift(self.bot.db, ctx.author.id)
+            check = await check_has_gift(self.bot.storage, ctx.author.id)
 
             if not check:
                 await ctx.send("You don't have anything to give up on")
@@ -244,31 +404,21 @@ class CoinDrop(commands.Cog):
                     await ctx.send("Cancelled.")
                     return
 
-                async with self.bot.db.acquire() as conn:
-                    gift = await conn.fetchval(
-                        """
-                        SELECT nickname
-                        FROM gifts 
-                        INNER JOIN user_data
-                        ON target_user_id = user_data.user_id
-                        WHERE gifts.user_id = $1 AND active 
-                        """, message.author.id)
-
-                    async with conn.transaction():
-                        await conn.execute(
-                            """
-                            DELETE FROM gifts
-                            WHERE active = TRUE AND user_id = $1
-                            """, ctx.author.id)
+                gift = await self.bot.storage.give_up(ctx.author.id)
+                active = self.forget_gift(ctx.author.id)
+                await self.bot.storage.publish("giveup", {'user_id': ctx.author.id})
 
+                if gift is None:
+                    await ctx.send("You don't have anything to give up on")
+                    return
+                self.bot.events.record("giveup", ctx.author.id, active.target_user_id if active else None)
                 await ctx.send(f"Deleted, the answer was **{gift.lower()}**")
         else:
-            async with self.bot.db.acquire() as conn:
-                check = await check_has_gift(self.bot.db, ctx.author.id)
-                if check:
-                    await ctx.send("You can only give up on gifts in DMs")
-                else:
-                    await ctx.send("You don't have anything to give up on")
+            check = await check_has_gift(self.bot.storage, ctx.author.id)
+            if check:
+                await ctx.send("You can only give up on gifts in DMs")
+            else:
+                await ctx.send("You don't have anything to give up on")
 
     @commands.check(utils.check_granted_server)
     @commands.command("join")
@@ -281,28 +431,22 @@ class CoinDrop(commands.Cog):
             joined = ',\n'.join(results)
             await ctx.send(f"{ctx.author.mention}, {joined}")
             return
-        async with self.bot.db.acquire() as conn:
-
-            record = await conn.fetchval("SELECT * FROM user_data WHERE user_id = $1", ctx.author.id)
+        record = await self.bot.storage.get_participant(ctx.author.id)
 
-            if record is None:
-                async with conn.transaction():
-                    ret_value = await conn.fetchrow(
-                        """
-                        INSERT INTO user_data (user_id, nickname)
-                        VALUES ($1, $2)
-                        ON CONFLICT (nickname) DO UPDATE
-                        SET nickname = $3
-                        RETURNING *
-                        """,
-
-                        ctx.author.id,
-                        nickname if nickname != '' else ctx.author.display_name,
-                        str(ctx.author.id), ## TO-DO change this to something more visually pleasant
-                    )
-                await ctx.send(f"{ctx.author.mention} has joined the Blob Santa Event as **{ret_value['nickname']}**!")
-            else:
+        if record is None:
+            try:
+                ret_value = await self.bot.storage.join(
+                    ctx.author.id,
+                    nickname if nickname != '' else ctx.author.display_name,
+                    str(ctx.author.id), ## TO-DO change this to something more visually pleasant
+                )
+            except StorageConflict:
                 await ctx.send(f"{ctx.author.mention} You have already joined the event. You can ask a staff member to change your nickname.")
+                return
+            await self.add_participant(ret_value)
+            await ctx.send(f"{ctx.author.mention} has joined the Blob Santa Event as **{ret_value['nickname']}**!")
+        else:
+            await ctx.send(f"{ctx.author.mention} You have already joined the event. You can ask a staff member to change your nickname.")
 
     @commands.has_permissions(ban_members=True)
     @commands.check(utils.check_granted_server)
@@ -313,18 +457,14 @@ class CoinDrop(commands.Cog):
             return
 
         currency_name = self.bot.config.get("currency", {})
-        singular_coin = currency_name.get("singular", "coin")
         plural_coin = currency_name.get("plural", "coins")
 
-        async with self.bot.db.acquire() as conn:
-            record = await conn.fetchrow("SELECT gifts_sent, gifts_received, nickname FROM user_data WHERE user_id = $1", target.id)
+        record = await self.bot.storage.get_participant(target.id)
 
-            if record is None:
-                await ctx.send(f"{target.mention} hasn't gotten any {plural_coin} yet!")
-            else:
-                coins = record["coins"]
-                coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
-                await ctx.send(f"{target.mention} {record['nickname']} has sent {record['gifts_sent']} and received {record['gifts_received']} gifts.")
+        if record is None:
+            await ctx.send(f"{target.mention} hasn't gotten any {plural_coin} yet!")
+        else:
+            await ctx.send(f"{target.mention} {record['nickname']} has sent {record['gifts_sent']} and received {record['gifts_received']} gifts.")
 
     @commands.cooldown(1, 4, commands.BucketType.user)
     @commands.cooldown(1, 1.5, commands.BucketType.channel)
@@ -335,24 +475,25 @@ class CoinDrop(commands.Cog):
             return
 
         limit = 8
+        modes = mode.split()
+        column = 'gifts_received' if 'received' in modes else 'gifts_sent'
 
-        if mode == 'long' and (not ctx.guild or ctx.author.guild_permissions.ban_members):
+        if 'long' in modes and (not ctx.guild or ctx.author.guild_permissions.ban_members):
             limit = 25
 
-        async with self.bot.db.acquire() as conn:
-            records = await conn.fetch("""
-            SELECT * FROM user_data
-            ORDER BY gifts_sent DESC
-            LIMIT $1
-            """, limit)
-
-            listing = []
-            for index, record in enumerate(records):
-                gifts = record["gifts_sent"]
-                gift_text = f"{gifts} gift{'' if gifts==1 else 's'} sent"
-                listing.append(f"{index+1}: <@{record['user_id']}> with {gift_text} as {record['nickname']}")
+        title = f"Top {limit} by gifts {'received' if column == 'gifts_received' else 'sent'}"
+        style = self.card_style()
+        if self.leaderboard.loaded:
+            ranking = self.leaderboard.received if column == 'gifts_received' else self.leaderboard.sent
+            card = await self.cards.get(("stats", column, limit) + style, render_leaderboard,
+                                        lambda: self.leaderboard_rows(ranking, limit), title, *style)
+        else:
+            # cold start, served by the gifts_sent/gifts_received indexes until the cog state is loaded
+            records = await self.bot.storage.leaderboard(column, limit)
+            rows = [(record['nickname'], record[column]) for record in records]
+            card = await self.cards.render(render_leaderboard, rows, title, *style)
 
-        await ctx.send(embed=discord.Embed(description="\n".join(listing), color=0xff0000))
+        await ctx.send(file=discord.File(io.BytesIO(card), "leaderboard.png"))
 
     @commands.cooldown(1, 4, commands.BucketType.user)
     @commands.cooldown(1, 1.5, commands.BucketType.channel)
@@ -362,31 +503,35 @@ class CoinDrop(commands.Cog):
         if not self.bot.db_available.is_set():
             return
 
-        async with self.bot.db.acquire() as conn:
-            records = await conn.fetch("""
-            SELECT nickname, gifts_sent, gifts_received FROM user_data
-            ORDER BY 
-            nickname ASC
-            """)
-
-            listing = []
-            for index, record in enumerate(records):
-                nickname = record["nickname"]
-                given = record["gifts_sent"]
-                received = record["gifts_received"]
-                score_text = f"({given}:{received})"
-                listing.append(f"{nickname} {score_text}")
-        embed = discord.Embed(color=0x69e0a5)
-        embed.set_footer(text='A list of all the people participating in gift-giving.')
-        embed.set_author(name="Blob Santa\'s List", icon_url = self.bot.config.get("embed_url"))
-        while len(listing) > 0:
-            embed.add_field(name='\u200b', value="\n".join(listing[:24]))
-            del listing[:24]
+        title = "Blob Santa's List"
+        style = self.card_style()
+        if self.leaderboard.loaded:
+            cards = await self.cards.get(("list",) + style, render_roster, self.roster_rows, title, *style)
+        else:
+            records = await self.bot.storage.roster()
+            rows = [(record['nickname'], record['gifts_sent'], record['gifts_received']) for record in records]
+            cards = await self.cards.render(render_roster, rows, title, *style)
+
         try:
-            await ctx.author.send(embed=embed)
+            for start in range(0, len(cards), CARDS_PER_MESSAGE):
+                await ctx.author.send(files=[discord.File(io.BytesIO(card), f"santas_list_{number}.png")
+                                             for number, card in enumerate(cards[start:start + CARDS_PER_MESSAGE],
+                                                                           start + 1)])
             await ctx.message.delete()
         except (discord.Forbidden, discord.HTTPException):
             pass
+
+    def card_style(self):
+        return self.bot.config.get("card_font"), self.bot.config.get("card_font_size", 16)
+
+    def leaderboard_rows(self, ranking, limit):
+        return [(self.roster.nickname(user_id), gifts) for user_id, gifts in ranking.top(limit)]
+
+    def roster_rows(self):
+        return sorted(((self.roster.nickname(user_id), self.leaderboard.sent.score(user_id),
+                        self.roster.received(user_id)) for user_id in self.roster),
+                      key=lambda row: row[0].casefold())
+
     # Testing purposes only
     # DELETE LATER
     @commands.check(utils.check_granted_server)
@@ -396,16 +541,16 @@ class CoinDrop(commands.Cog):
             await ctx.send("No connection to database.")
             return
 
-        async with self.bot.db.acquire() as conn:
-            record = await conn.fetchrow("SELECT * FROM user_data WHERE user_id = $1", ctx.author.id)
-            if record is None:
-                await ctx.send("This user doesn't have a database entry.")
-                return
+        record = await self.bot.storage.get_participant(ctx.author.id)
+        if record is None:
+            await ctx.send("This user doesn't have a database entry.")
+            return
 
-            async with conn.transaction():
-                await conn.execute("DELETE FROM user_data WHERE user_id = $1", ctx.author.id)
+        await self.bot.storage.delete_participant(ctx.author.id)
+        await self.remove_participants(ctx.author.id, ctx.author.id + 1)
+        self.bot.events.record("reset", ctx.author.id)
 
-            await ctx.send(f"Cleared entry for {ctx.author.id}")
+        await ctx.send(f"Cleared entry for {ctx.author.id}")
     # Testing purposes only
     # DELETE LATER
     @commands.check(utils.check_granted_server)
@@ -416,21 +561,13 @@ class CoinDrop(commands.Cog):
             joined = ',\n'.join(results)
             await ctx.send(f"{ctx.author.mention}, {joined}")
             return
-        async with self.bot.db.acquire() as conn:
-            async with conn.transaction():
-                ret_value = await conn.fetchval(
-                    """
-                    INSERT INTO user_data (user_id, nickname)
-                    VALUES ($1, $2)
-                    ON CONFLICT (nickname) DO UPDATE
-                    SET nickname = $3
-                    RETURNING nickname
-                    """,
-                    random.randint(0, 10000),
-                    nickname if nickname != '' else f"Dummy{random.randint(0, 100000)}",
-                    f"Dummy{random.randint(0, 100000)}",  ## TO-DO change this to something more visually pleasant
-                )
-                await ctx.send(f"Dummy has joined the Blob Santa Event as **{ret_value}**!")
+        ret_value = await self.bot.storage.join(
+            random.randint(0, 10000),
+            nickname if nickname != '' else f"Dummy{random.randint(0, 100000)}",
+            f"Dummy{random.randint(0, 100000)}",  ## TO-DO change this to something more visually pleasant
+        )
+        await self.add_participant(ret_value)
+        await ctx.send(f"Dummy has joined the Blob Santa Event as **{ret_value['nickname']}**!")
     # Testing purposes only
     # DELETE LATER
     @commands.check(utils.check_granted_server)
@@ -440,10 +577,9 @@ class CoinDrop(commands.Cog):
             await ctx.send("No connection to database.")
             return
 
-        async with self.bot.db.acquire() as conn:
-            async with conn.transaction():
-                await conn.execute("DELETE FROM user_data WHERE user_id <= 10000")
-            await ctx.send(f"Cleared entry for dummies")
+        await self.bot.storage.delete_participants(0, 10001)
+        await self.remove_participants(0, 10001)
+        await ctx.send(f"Cleared entry for dummies")
     
     @commands.has_permissions(ban_members=True)
     @commands.check(utils.check_granted_server)
@@ -454,34 +590,47 @@ class CoinDrop(commands.Cog):
             await ctx.send("No connection to database.")
             return
         user_id = int(user_id)
-        async with self.bot.db.acquire() as conn:
-            record = await conn.fetchrow("SELECT * FROM user_data WHERE user_id = $1", user_id)
-            if record is None:
-                await ctx.send("This user doesn't have a database entry.")
-                return
+        record = await self.bot.storage.get_participant(user_id)
+        if record is None:
+            await ctx.send("This user doesn't have a database entry.")
+            return
 
-            confirm_text = f"confirm {random.randint(0, 999999):06}"
+        confirm_text = f"confirm {random.randint(0, 999999):06}"
 
-            await ctx.send(f"Are you sure? This user has {record['gifts_sent']} coins, last picking one up at "
-                           f"{record['last_gift']} UTC. (type '{confirm_text}' or 'cancel')")
+        await ctx.send(f"Are you sure? This user has {record['gifts_sent']} coins, last picking one up at "
+                       f"{record['last_gift']} UTC. (type '{confirm_text}' or 'cancel')")
 
-            def wait_check(msg):
-                return msg.author.id == ctx.author.id and msg.content.lower() in (confirm_text, "cancel")
+        def wait_check(msg):
+            return msg.author.id == ctx.author.id and msg.content.lower() in (confirm_text, "cancel")
 
-            try:
-                validate_message = await self.bot.wait_for('message', check=wait_check, timeout=30)
-            except asyncio.TimeoutError:
-                await ctx.send(f"Timed out request to reset {user_id}.")
+        try:
+            validate_message = await self.bot.wait_for('message', check=wait_check, timeout=30)
+        except asyncio.TimeoutError:
+            await ctx.send(f"Timed out request to reset {user_id}.")
+            return
+        else:
+            if validate_message.content.lower() == 'cancel':
+                await ctx.send("Cancelled.")
                 return
-            else:
-                if validate_message.content.lower() == 'cancel':
-                    await ctx.send("Cancelled.")
-                    return
 
-                async with conn.transaction():
-                    await conn.execute("DELETE FROM user_data WHERE user_id = $1", user_id)
+            await self.bot.storage.delete_participant(user_id)
+            await self.remove_participants(user_id, user_id + 1)
+            self.bot.events.record("reset", user_id)
+
+            await ctx.send(f"Cleared entry for {user_id}")
+
+    @commands.has_permissions(ban_members=True)
+    @commands.check(utils.check_granted_server)
+    @commands.command("archive_gifts")
+    async def archive_gifts_command(self, ctx: commands.Context):
+        """Move settled gifts out of the live gifts table"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        archived = await self.bot.storage.archive_gifts()
 
-                await ctx.send(f"Cleared entry for {user_id}")
+        await ctx.send(f"Archived {archived} settled gifts.")
 
 def setup(bot):
     bot.add_cog(CoinDrop(bot))
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import bisect
+import random
+from collections import Counter, deque, namedtuple
+
+from tools import puzzle_variants
+
+
+ActiveGift = namedtuple("ActiveGift", "target_user_id answer issued_at")
+
+
+def normalize_label(text: str) -> str:
+    return text.lower().strip().replace(' ', '')
+
+
+class GiftIndex:
+    """In-process mirror of the active rows in ``gifts``, keyed by gifter."""
+
+    def __init__(self):
+        self._gifts = {}
+
+    def __contains__(self, user_id):
+        return user_id in self._gifts
+
+    def __len__(self):
+        return len(self._gifts)
+
+    def get(self, user_id):
+        return self._gifts.get(user_id)
+
+    def set(self, user_id, target_user_id, nickname, issued_at):
+        self._gifts[user_id] = ActiveGift(target_user_id, normalize_label(nickname), issued_at)
+
+    def pop(self, user_id):
+        return self._gifts.pop(user_id, None)
+
+    def forget(self, predicate):
+        """Drop gifts whose gifter or target matches ``predicate``, mirroring ON DELETE CASCADE."""
+        removed = [user_id for user_id, gift in self._gifts.items()
+                   if predicate(user_id) or predicate(gift.target_user_id)]
+        for user_id in removed:
+            del self._gifts[user_id]
+        return removed
+
+    def check(self, user_id, guess: str):
+        """Return the active gift if ``guess`` solves it, otherwise None."""
+        gift = self._gifts.get(user_id)
+        if gift is not None and normalize_label(guess) == gift.answer:
+            return gift
+        return None
+
+    def load(self, records):
+        for record in records:
+            self._gifts.setdefault(record['user_id'], ActiveGift(
+                record['target_user_id'], normalize_label(record['nickname']), record['issued_at']))
+
+
+class DropGate:
+    """Admits at most one drop per user and ``limit`` drops overall, counting the ones it turns away."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.skipped = Counter()
+        self._in_flight = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._in_flight
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def try_acquire(self, user_id):
+        if user_id in self._in_flight:
+            self.skipped['user'] += 1
+            return False
+        if len(self._in_flight) >= self.limit:
+            self.skipped['capacity'] += 1
+            return False
+        self._in_flight.add(user_id)
+        return True
+
+    def release(self, user_id):
+        self._in_flight.discard(user_id)
+
+
+class RosterSampler:
+    """Participants kept in an array with an id -> position map, so joins, removals and draws are O(1)."""
+
+    def __init__(self):
+        self._ids = []
+        self._positions = {}
+        self._nicknames = {}
+        self._received = {}
+
+    def __contains__(self, user_id):
+        return user_id in self._positions
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def nickname(self, user_id):
+        return self._nicknames.get(user_id)
+
+    def received(self, user_id):
+        return self._received.get(user_id, 0)
+
+    def add(self, user_id, nickname, gifts_received=0):
+        if user_id not in self._positions:
+            self._positions[user_id] = len(self._ids)
+            self._ids.append(user_id)
+        self._nicknames[user_id] = nickname
+        self._received[user_id] = gifts_received
+
+    def remove(self, user_id):
+        position = self._positions.pop(user_id, None)
+        if position is None:
+            return
+        last = self._ids.pop()
+        if last != user_id:
+            self._ids[position] = last
+            self._positions[last] = position
+        del self._nicknames[user_id]
+        del self._received[user_id]
+
+    def forget(self, predicate):
+        for user_id in [user_id for user_id in self._ids if predicate(user_id)]:
+            self.remove(user_id)
+
+    def add_received(self, user_id, amount=1):
+        if user_id in self._received:
+            self._received[user_id] += amount
+
+    def _draw(self, excluded):
+        count = len(self._ids)
+        if excluded is None:
+            return self._ids[random.randrange(count)]
+        # draw from the other count - 1 slots by skipping over the excluded position
+        index = random.randrange(count - 1)
+        if index >= excluded:
+            index += 1
+        return self._ids[index]
+
+    def sample(self, exclude=None, weighted=False):
+        """Pick a random participant other than ``exclude``, or None if there is nobody to pick.
+
+        When ``weighted`` is set, the better of two draws (fewest gifts received) wins, which keeps
+        recipients balanced without having to maintain cumulative weights.
+        """
+        excluded = self._positions.get(exclude)
+        if len(self._ids) - (excluded is not None) < 1:
+            return None
+
+        choice = self._draw(excluded)
+        if weighted:
+            other = self._draw(excluded)
+            if self._received[other] < self._received[choice]:
+                choice = other
+        return choice
+
+    def load(self, records):
+        for record in records:
+            self.add(record['user_id'], record['nickname'], record['gifts_received'])
+
+
+class CooldownTable:
+    """Last drop time per participant. Users missing from the table have not joined the event."""
+
+    def __init__(self):
+        self._last_gift = {}
+
+    def __contains__(self, user_id):
+        return user_id in self._last_gift
+
+    def set(self, user_id, when):
+        self._last_gift[user_id] = when
+
+    def remove(self, user_id):
+        self._last_gift.pop(user_id, None)
+
+    def forget(self, predicate):
+        for user_id in [user_id for user_id in self._last_gift if predicate(user_id)]:
+            del self._last_gift[user_id]
+
+    def ready(self, user_id, now, cooldown):
+        last_gift = self._last_gift.get(user_id)
+        return last_gift is not None and (now - last_gift).total_seconds() > cooldown
+
+    def load(self, records):
+        for record in records:
+            self._last_gift.setdefault(record['user_id'], record['last_gift'])
+
+
+class DropScheduler:
+    """Per-channel token buckets that pace drops to a target rate regardless of chat volume.
+
+    A bucket refills at ``per_minute / 60`` tokens a second and holds up to ``burst``. A message
+    claims a token unless its author won one of the channel's last ``fairness`` drops, so the token
+    waits for somebody else instead of going to whoever posts most. If a full bucket goes unclaimed
+    for another refill interval, the recent winners may have it after all.
+    """
+
+    def __init__(self):
+        # channel id -> (accrued tokens, uncapped so the waiting time is known, last refill)
+        self._buckets = {}
+        self._winners = {}
+
+    def has_token(self, channel_id, now, per_minute, burst=1):
+        if per_minute <= 0:
+            return False
+
+        accrued, updated = self._buckets.get(channel_id, (burst, now))
+        accrued += (now - updated) * per_minute / 60
+        self._buckets[channel_id] = (accrued, now)
+        return min(accrued, burst) >= 1
+
+    def allows(self, channel_id, user_id, burst=1):
+        """Whether the token ``has_token`` found may go to ``user_id``. Call ``grant`` once the drop happens."""
+        if user_id not in self._winners.get(channel_id, ()):
+            return True
+        accrued, _ = self._buckets[channel_id]
+        return accrued >= burst + 1
+
+    def grant(self, channel_id, user_id, burst=1, fairness=0):
+        accrued, updated = self._buckets[channel_id]
+        self._buckets[channel_id] = (min(accrued, burst) - 1, updated)
+
+        winners = self._winners.get(channel_id)
+        if winners is None or winners.maxlen != fairness:
+            winners = self._winners[channel_id] = deque(winners or (), maxlen=fairness)
+        winners.append(user_id)
+
+
+class PuzzlePool:
+    """Label puzzles precomputed per participant, and the hints each gifter has been shown.
+
+    Variants are generated when a participant joins or is renamed, so a drop only picks from the
+    cached pool. Retries on the same target never repeat a hint: once a gifter has seen the whole
+    pool it is replaced with fresh variants, and only names too short to have any left start over.
+    """
+
+    def __init__(self, size=12):
+        self.size = size
+        # user id -> (nickname, puzzles)
+        self._puzzles = {}
+        # gifter id -> (target user id, keys of the hints shown for it)
+        self._shown = {}
+
+    def __contains__(self, user_id):
+        return user_id in self._puzzles
+
+    def __len__(self):
+        return len(self._puzzles)
+
+    def add(self, user_id, nickname):
+        cached = self._puzzles.get(user_id)
+        if cached is None or cached[0] != nickname:
+            self._puzzles[user_id] = (nickname, puzzle_variants(nickname, self.size))
+
+    def forget(self, predicate):
+        for user_id in [user_id for user_id in self._puzzles if predicate(user_id)]:
+            del self._puzzles[user_id]
+        for user_id in [user_id for user_id, (target_user_id, _) in self._shown.items()
+                        if predicate(user_id) or predicate(target_user_id)]:
+            del self._shown[user_id]
+
+    def pick(self, user_id, target_user_id, nickname, difficulty=(0.0, 1.0), fresh=False):
+        """A hint for ``user_id``'s gift to ``target_user_id`` they haven't been shown yet.
+
+        ``fresh`` starts a new gift, forgetting the hints shown for the last one. Puzzles outside the
+        ``difficulty`` range are only used when no other is left, the closest one first.
+        """
+        # a no-op once cached, covers targets that joined through another process or were renamed
+        self.add(target_user_id, nickname)
+        puzzles = self._puzzles[target_user_id][1]
+
+        shown_for, shown = self._shown.get(user_id, (None, None))
+        if fresh or shown_for != target_user_id:
+            shown = set()
+            self._shown[user_id] = (target_user_id, shown)
+
+        unseen = [puzzle for puzzle in puzzles if puzzle.key not in shown]
+        if not unseen:
+            puzzles = puzzle_variants(nickname, self.size, exclude=shown)
+            if puzzles:
+                self._puzzles[target_user_id] = (nickname, puzzles)
+            else:
+                shown.clear()
+                puzzles = self._puzzles[target_user_id][1]
+            unseen = puzzles
+
+        low, high = difficulty
+        suitable = [puzzle for puzzle in unseen if low <= puzzle.difficulty <= high]
+        if suitable:
+            puzzle = random.choice(suitable)
+        else:
+            puzzle = min(unseen, key=lambda puzzle: max(low - puzzle.difficulty, puzzle.difficulty - high))
+        shown.add(puzzle.key)
+        return puzzle
+
+    def load(self, records):
+        for record in records:
+            self.add(record['user_id'], record['nickname'])
+
+
+class Ranking:
+    """Participants ordered by a single score, highest first, maintained with bisection."""
+
+    def __init__(self):
+        self._order = []
+        self._scores = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def score(self, user_id):
+        return self._scores.get(user_id, 0)
+
+    def set(self, user_id, score):
+        old_score = self._scores.get(user_id)
+        if old_score == score:
+            return
+        if old_score is not None:
+            del self._order[bisect.bisect_left(self._order, (-old_score, user_id))]
+        self._scores[user_id] = score
+        bisect.insort(self._order, (-score, user_id))
+
+    def remove(self, user_id):
+        score = self._scores.pop(user_id, None)
+        if score is not None:
+            del self._order[bisect.bisect_left(self._order, (-score, user_id))]
+
+    def forget(self, predicate):
+        self._scores = {user_id: score for user_id, score in self._scores.items() if not predicate(user_id)}
+        self._order = [entry for entry in self._order if not predicate(entry[1])]
+
+    def top(self, limit):
+        return [(user_id, -score) for score, user_id in self._order[:limit]]
+
+    def load(self, scores):
+        self._scores.update(scores)
+        self._order = sorted((-score, user_id) for user_id, score in self._scores.items())
+
+
+class Leaderboard:
+    """Rankings by gifts sent and gifts received, updated as scores commit."""
+
+    def __init__(self):
+        self.sent = Ranking()
+        self.received = Ranking()
+        self.loaded = False
+
+    def update(self, user_id, gifts_sent, gifts_received):
+        self.sent.set(user_id, gifts_sent)
+        self.received.set(user_id, gifts_received)
+
+    def forget(self, predicate):
+        self.sent.forget(predicate)
+        self.received.forget(predicate)
+
+    def load(self, records):
+        self.sent.load((record['user_id'], record['gifts_sent']) for record in records)
+        self.received.load((record['user_id'], record['gifts_received']) for record in records)
+        self.loaded = True
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from types import MappingProxyType
+
+import toml
+
+
+CONFIG_PATH = "config.toml"
+
+# read once at startup, reloading the config does not change them
+RESTART_KEYS = ("token", "database", "storage", "max_concurrent_drops", "send_concurrency",
+                "announce_window", "announce_burst", "metrics_host", "metrics_port", "shard_ids", "shard_count",
+                "cache_sync", "event_flush_interval", "event_batch_size",
+                "warm_up_buffer", "reward_interval", "reward_budget", "task_concurrency",
+                "task_queue", "logging", "error_window",
+                "render_workers", "puzzle_pool_size")
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def _ids(raw, key):
+    try:
+        return frozenset(int(value) for value in raw.get(key, []))
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a list of ids") from None
+
+
+def _number(raw, key, default, kind=float):
+    try:
+        return kind(raw.get(key, default))
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a number") from None
+
+
+def _rates(raw, key):
+    try:
+        return MappingProxyType({int(channel_id): float(rate) for channel_id, rate in raw.get(key, {}).items()})
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"{key} must map channel ids to drops per minute") from None
+
+
+def _thresholds(raw, key):
+    # toml keys are always strings, these are gift counts
+    try:
+        return tuple(sorted((int(threshold), int(role_id)) for threshold, role_id in raw.get(key, {}).items()))
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"{key} must map gift counts to role ids") from None
+
+
+def _range(raw, key, default):
+    try:
+        low, high = (float(value) for value in raw.get(key, default))
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a [low, high] pair of numbers") from None
+    if low > high:
+        raise ValueError(f"{key} must not start above where it ends")
+    return low, high
+
+
+class Config:
+    """``config.toml`` compiled into an immutable structure.
+
+    The values read on every message are checked and converted once, ids go into frozensets, and
+    everything else stays reachable through ``get`` and ``[]`` like the dict it was loaded from.
+    The database credentials are split off into ``credentials`` and never exposed through ``get``.
+    """
+
+    __slots__ = ("_values", "credentials", "drop_channels", "admin_users", "present_log", "drops_per_minute",
+                 "drop_rates", "drop_burst", "drop_fairness", "cooldown_time", "balance_targets", "reward_guild",
+                 "rewards", "puzzle_difficulty")
+
+    def __init__(self, raw):
+        raw = dict(raw)
+        credentials = raw.pop("database", None)
+        present_log = raw.get("present_log")
+
+        values = {
+            "credentials": freeze(credentials) if credentials is not None else None,
+            "drop_channels": _ids(raw, "drop_channels"),
+            "admin_users": _ids(raw, "admin_users"),
+            "present_log": int(present_log) if present_log else None,
+            "drops_per_minute": _number(raw, "drops_per_minute", 2),
+            "drop_rates": _rates(raw, "drop_rates"),
+            "drop_burst": _number(raw, "drop_burst", 1),
+            "drop_fairness": _number(raw, "drop_fairness", 3, int),
+            "cooldown_time": _number(raw, "cooldown_time", 30),
+            "balance_targets": bool(raw.get("balance_targets", False)),
+            "reward_guild": _number(raw, "reward_guild", 0, int) or None,
+            "rewards": MappingProxyType({
+                "gifts_sent": _thresholds(raw, "reward_roles"),
+                "gifts_received": _thresholds(raw, "received_reward_roles"),
+            }),
+            "puzzle_difficulty": _range(raw, "puzzle_difficulty", (0.25, 1.0)),
+        }
+        if values["drop_burst"] < 1:
+            raise ValueError("drop_burst must be at least 1")
+        if values["drop_fairness"] < 0:
+            raise ValueError("drop_fairness can't be negative")
+
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+        frozen = {key: freeze(value) for key, value in raw.items()}
+        frozen.update((name, values[name]) for name in ("drop_channels", "admin_users") if name in raw)
+        object.__setattr__(self, "_values", MappingProxyType(frozen))
+
+    @classmethod
+    def load(cls, path=CONFIG_PATH):
+        with open(path, 'r', encoding='utf-8') as fp:
+            return cls(toml.load(fp))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config is read-only, reload it instead")
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def drop_rate(self, channel_id):
+        """Target drops per minute in a drop channel."""
+        return self.drop_rates.get(channel_id, self.drops_per_minute)
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def changed_keys(self, other):
+        """Top-level keys whose value differs between this config and ``other``."""
+        keys = set(self._values) | set(other._values)
+        changed = {key for key in keys if self._values.get(key) != other._values.get(key)}
+        if self.credentials != other.credentials:
+            changed.add("database")
+        return sorted(changed)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+
+COMMAND_ERRORS = Counter("dropbot_command_errors_total", "Unexpected command errors, reported or not", ["result"])
+ERRORS_TRACKED = Gauge("dropbot_errors_tracked", "Distinct command errors currently tracked")
+
+
+class ErrorEntry:
+    __slots__ = ("error_hash", "digest", "context", "count", "first_seen", "last_seen", "reported_at",
+                 "suppressed")
+
+    def __init__(self, error_hash, digest, context, now):
+        self.error_hash = error_hash
+        self.digest = digest
+        self.context = context
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.reported_at = None
+        self.suppressed = 0
+
+    @property
+    def summary(self):
+        """The last line of the traceback, which names the exception."""
+        return self.digest.strip().splitlines()[-1]
+
+
+class ErrorAggregator:
+    """Counts command errors by traceback hash so a systematic failure is reported once per ``window``.
+
+    Each hash keeps its count, when it was first and last seen, and the traceback and context of its
+    first occurrence. ``record`` says whether this occurrence should be logged and posted, later ones
+    inside the window only bump the counters and are summed into the next report. At most
+    ``capacity`` hashes are kept, the one seen longest ago is forgotten first.
+    """
+
+    def __init__(self, window=300.0, capacity=500):
+        self.window = window
+        self.capacity = capacity
+        self._entries = OrderedDict()
+
+        ERRORS_TRACKED.set_function(lambda: len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, prefix):
+        """Find an entry by its hash or a prefix of it."""
+        for error_hash, entry in self._entries.items():
+            if error_hash.startswith(prefix):
+                return entry
+        return None
+
+    def record(self, error_hash, digest, context, now=None):
+        """Count an occurrence. Returns None while the hash is muted, otherwise how many occurrences
+        were muted since it was last reported."""
+        now = time.time() if now is None else now
+        entry = self._entries.get(error_hash)
+        if entry is None:
+            entry = self._entries[error_hash] = ErrorEntry(error_hash, digest, context, now)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(error_hash)
+
+        entry.count += 1
+        entry.last_seen = now
+        if entry.reported_at is not None and now - entry.reported_at < self.window:
+            entry.suppressed += 1
+            COMMAND_ERRORS.inc(result="suppressed")
+            return None
+
+        entry.reported_at = now
+        suppressed, entry.suppressed = entry.suppressed, 0
+        COMMAND_ERRORS.inc(result="reported")
+        return suppressed
+
+    def top(self, limit=10):
+        return sorted(self._entries.values(), key=lambda entry: (-entry.count, -entry.last_seen))[:limit]
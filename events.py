@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import pathlib
+from datetime import datetime
+
+from metrics import Counter, Gauge
+
+
+GIFT_EVENTS = Counter("dropbot_gift_events_total", "Gift events written to the event log", ["kind"])
+GIFT_EVENTS_PENDING = Gauge("dropbot_gift_events_pending", "Gift events waiting to be written")
+
+EXPORT_PATH = pathlib.Path("exports")
+
+
+class EventLog:
+    """Buffers gift events and appends them to storage in batches.
+
+    Recording an event never waits on the database. The buffer is written with a single COPY
+    every ``flush_interval`` seconds, or as soon as it holds ``batch_size`` events.
+    """
+
+    def __init__(self, bot, flush_interval=5.0, batch_size=500):
+        self.bot = bot
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.logger = logging.getLogger("dropbot.events")
+
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._writer = None
+
+        GIFT_EVENTS_PENDING.set_function(lambda: len(self._pending))
+
+    def start(self):
+        if self._writer is None:
+            self._writer = self.bot.loop.create_task(self._write_loop())
+
+    def record(self, kind, user_id, target_user_id=None, when=None, solve_seconds=None):
+        self._pending.append((kind, user_id, target_user_id, when or datetime.utcnow(), solve_seconds))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        try:
+            await self.bot.storage.record_events(batch)
+        except BaseException:
+            # put the batch back in front, so ordering holds and the next flush retries it
+            self._pending[:0] = batch
+            raise
+
+        for event in batch:
+            GIFT_EVENTS.inc(kind=event[0])
+
+    async def _write_loop(self):
+        await self.bot.db_available.wait()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception(f"Failed to write {len(self._pending)} gift events, retrying later.")
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        if self.bot.storage is None:
+            return
+        try:
+            await self.flush()
+        except Exception:
+            self.logger.exception(f"Dropping {len(self._pending)} gift events that could not be written.")
+
+
+async def export_events(storage, directory=EXPORT_PATH, since=None, until=None):
+    """Dump the gift event log to a timestamped CSV in ``directory``, returns the path and row count."""
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"gift_events-{datetime.utcnow():%Y%m%dT%H%M%S}.csv"
+    rows = await storage.export_events(path, since, until)
+    return path, rows
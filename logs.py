@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+
+TEXT_FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+
+
+class RotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Rolls the file over at the usual time boundary, or earlier once it reaches ``max_bytes``.
+
+    Backups are named for their interval like ``dropbot.log.2020-12-24``, further rollovers in the
+    same interval add ``.1``, ``.2``... rather than replacing it. ``backupCount`` counts every backup.
+    """
+
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, encoding='utf-8', **kwargs)
+        self.max_bytes = max_bytes
+
+    def rotation_filename(self, default_name):
+        # doRollover removes whatever already sits at the name, which would be this interval's last backup
+        name = super().rotation_filename(default_name)
+        candidate, index = name, 0
+        while os.path.exists(candidate):
+            index += 1
+            candidate = f"{name}.{index}"
+        return candidate
+
+    def getFilesToDelete(self):
+        directory, base = os.path.split(self.baseFilename)
+        backups = []
+        for name in os.listdir(directory):
+            if not name.startswith(base + "."):
+                continue
+            stamp, _, index = name[len(base) + 1:].partition(".")
+            try:
+                backups.append((time.strptime(stamp, self.suffix), int(index or 0), os.path.join(directory, name)))
+            except ValueError:
+                continue
+        backups.sort()
+        return [path for _, _, path in backups[:max(len(backups) - self.backupCount, 0)]]
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, os.SEEK_END)
+            return self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the ``event`` passed through ``extra`` merged in."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "event", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class EventFilter(logging.Filter):
+    """Passes only records that carry a structured ``event``."""
+
+    def filter(self, record):
+        return hasattr(record, "event")
+
+
+class SamplingFilter(logging.Filter):
+    """Thins out chatty loggers below WARNING before they reach the queue, sparing structured events.
+
+    ``sample`` keeps that share of a logger's records, ``rate_limits`` caps a logger at that many
+    records a second. Both are keyed by logger name and apply to child loggers too. Whatever gets
+    dropped is counted and reported with the next record let through.
+    """
+
+    def __init__(self, sample=None, rate_limits=None):
+        super().__init__()
+        self.sample = dict(sample or {})
+        self.rate_limits = dict(rate_limits or {})
+        self._buckets = {}
+        self._dropped = {}
+
+    def _lookup(self, settings, name):
+        while name:
+            if name in settings:
+                return name, settings[name]
+            name = name.rpartition('.')[0]
+        return None, None
+
+    def filter(self, record):
+        # structured events feed events.jsonl, which has to stay complete however busy it gets
+        if record.levelno >= logging.WARNING or hasattr(record, "event"):
+            return True
+
+        _, share = self._lookup(self.sample, record.name)
+        if share is not None and random.random() >= share:
+            return False
+
+        key, limit = self._lookup(self.rate_limits, record.name)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (limit, now))
+        tokens = min(limit, tokens + (now - updated) * limit)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            self._dropped[key] = self._dropped.get(key, 0) + 1
+            return False
+
+        self._buckets[key] = (tokens - 1, now)
+        dropped = self._dropped.pop(key, 0)
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} more {key} records dropped by the rate limit)"
+        return True
+
+
+def setup_logging(settings=None):
+    """Route every record through a queue to a listener thread that does the actual writing.
+
+    The event loop only pays for filtering and a ``put_nowait``, the file rotation, formatting and
+    disk or terminal I/O all happen on the listener thread.
+    """
+    settings = settings or {}
+    formatter = logging.Formatter(TEXT_FORMAT)
+
+    text = RotatingFileHandler(settings.get("file", "dropbot.log"), max_bytes=settings.get("max_bytes", 10 << 20),
+                               when=settings.get("when", "midnight"), backupCount=settings.get("backup_count", 14))
+    text.setFormatter(formatter)
+
+    events = RotatingFileHandler(settings.get("event_file", "events.jsonl"),
+                                 max_bytes=settings.get("max_bytes", 10 << 20),
+                                 when=settings.get("when", "midnight"), backupCount=settings.get("backup_count", 14))
+    events.setFormatter(JsonFormatter())
+    events.addFilter(EventFilter())
+
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(settings.get("sample"), settings.get("rate_limits")))
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(records, text, events, stream, respect_handler_level=True)
+    listener.start()
+
+    @atexit.register
+    def flush():
+        # the listener may already have been stopped by hand, stopping it twice raises
+        if listener._thread is not None:
+            listener.stop()
+
+    return listener
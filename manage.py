@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Maintenance tasks that run against the database without starting the bot.
+
+    python manage.py export-events --since 2020-12-01 --output exports/
+    python manage.py import-roster returning.csv
+    python manage.py import-roster --dummies 10000
+    python manage.py reset-users --file ids.txt
+
+Running bots with cache_sync on are notified of imports and resets.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+
+import asyncpg
+
+from config import Config
+from events import EXPORT_PATH, export_events
+from migrate import apply_migrations
+from roster import dummy_roster, export_roster, parse_roster
+from storage import PostgresStorage
+
+
+async def export_events_task(storage, args):
+    path, rows = await export_events(storage, args.output, since=args.since, until=args.until)
+    print(f"Exported {rows} gift events to {path}")
+
+
+async def import_roster_task(storage, args):
+    if args.dummies:
+        records = dummy_roster(args.dummies)
+    elif args.path:
+        with open(args.path, 'r', encoding='utf-8-sig', newline='') as fp:
+            records = parse_roster(fp)
+    else:
+        raise SystemExit("Give a roster file or --dummies.")
+
+    inserted = await storage.import_participants(records)
+    await storage.publish("resync", {})
+    print(f"Imported {len(inserted)} of {len(records)} participants, "
+          f"{len(records) - len(inserted)} skipped because the id or nickname was taken.")
+
+
+async def export_roster_task(storage, args):
+    for path, rows in await export_roster(storage, args.output):
+        print(f"Exported {rows} rows to {path}")
+
+
+async def reset_users_task(storage, args):
+    user_ids = set(args.user_ids)
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as fp:
+            user_ids.update(int(line) for line in fp if line.strip())
+    if not user_ids:
+        raise SystemExit("Give the ids of the users to reset.")
+
+    if not args.yes and input(f"Delete {len(user_ids)} users and their gifts? [y/N] ").lower() != "y":
+        print("Cancelled.")
+        return
+
+    deleted = await storage.delete_participant_ids(user_ids)
+    await storage.record_events([("reset", user_id, None, datetime.utcnow(), None) for user_id in deleted])
+    await storage.publish_forget_ids(deleted)
+    print(f"Cleared {len(deleted)} entries, {len(user_ids) - len(deleted)} ids had none.")
+
+
+async def main(args):
+    config = Config.load(args.config)
+    if not config.credentials:
+        raise SystemExit("No database credentials in the config.")
+
+    pool = await asyncpg.create_pool(**dict(config.credentials))
+    storage = PostgresStorage(pool, notify=True)
+    try:
+        await apply_migrations(pool)
+        await args.task(storage, args)
+    finally:
+        await storage.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="config.toml")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export-events", help="dump the gift event log to CSV")
+    export.add_argument("--since", type=datetime.fromisoformat, default=None, help="first UTC timestamp to include")
+    export.add_argument("--until", type=datetime.fromisoformat, default=None, help="UTC timestamp to stop before")
+    export.add_argument("--output", default=EXPORT_PATH, help="directory to write the file to")
+    export.set_defaults(task=export_events_task)
+
+    importer = subparsers.add_parser("import-roster", help="bulk add participants from a CSV roster")
+    importer.add_argument("path", nargs="?", help="CSV with user_id and nickname columns")
+    importer.add_argument("--dummies", type=int, default=0, help="generate this many dummies instead")
+    importer.set_defaults(task=import_roster_task)
+
+    exporter = subparsers.add_parser("export-roster", help="dump user_data and gifts to CSV")
+    exporter.add_argument("--output", default=EXPORT_PATH, help="directory to write the files to")
+    exporter.set_defaults(task=export_roster_task)
+
+    reset = subparsers.add_parser("reset-users", help="delete many participants after one confirmation")
+    reset.add_argument("user_ids", nargs="*", type=int)
+    reset.add_argument("--file", help="file with one user id per line")
+    reset.add_argument("--yes", action="store_true", help="skip the confirmation")
+    reset.set_defaults(task=reset_users_task)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.get_event_loop().run_until_complete(main(parse_args()))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import collections
+import contextlib
+import logging
+import time
+
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        # re-registering replaces the old metric, so reloaded extensions start counting afresh
+        self._metrics[metric.name] = metric
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {value:g}" for name, labels, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Short human-readable lines, with histograms summarised by count, mean and quantiles."""
+        lines = []
+        for metric in self:
+            lines.extend(metric.summary())
+        return lines
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        return []
+
+    def summary(self):
+        return [f"{self.name}{labels} {value:g}" for _, labels, value in self.samples()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = collections.Counter()
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        self._values[self._key(labels)] += amount
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, *args, function=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = collections.Counter()
+        self._function = function
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        self._values[self._key(labels)] += amount
+
+    def dec(self, amount=1, **labels):
+        self._values[self._key(labels)] -= amount
+
+    def get(self, **labels):
+        if self._function is not None:
+            return self._function()
+        return self._values[self._key(labels)]
+
+    def set_function(self, function):
+        """Read the value from ``function()`` at collection time instead of tracking it."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            return [(self.name, "", self._function())]
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = collections.Counter()
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        counts = self._counts.get(self._key(labels))
+        if not counts:
+            return 0.0
+        rank = q * sum(counts)
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            if running >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        for key, counts in self._counts.items():
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [("le", le)]), running))
+            samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), self._sums[key]))
+            samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), running))
+        return samples
+
+    def summary(self):
+        lines = []
+        for key, counts in self._counts.items():
+            total = sum(counts)
+            labels = dict(zip(self.labelnames, key))
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} count={total} "
+                         f"mean={self._sums[key] / total:.4g} p50<={self.quantile(.5, **labels):g} "
+                         f"p99<={self.quantile(.99, **labels):g}")
+        return lines
+
+
+POOL_ACQUIRE_SECONDS = Histogram("dropbot_pool_acquire_seconds", "Time spent waiting for a database connection")
+POOL_IN_USE = Gauge("dropbot_pool_connections_in_use", "Database connections currently checked out")
+
+
+class TimedPool:
+    """Wraps an asyncpg pool so every acquire records its wait time and the connections in use."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.in_use = 0
+        self._released = asyncio.Condition()
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, *, timeout=None):
+        start = time.perf_counter()
+        conn = await self._pool.acquire(timeout=timeout)
+        POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+        self.in_use += 1
+        POOL_IN_USE.inc()
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+            self.in_use -= 1
+            POOL_IN_USE.dec()
+            async with self._released:
+                self._released.notify()
+
+    async def wait_for_free(self, size):
+        """Wait until fewer than ``size`` connections are checked out, woken by releases."""
+        async with self._released:
+            await self._released.wait_for(lambda: self.in_use < size)
+
+
+async def start_http_server(host, port, registry=REGISTRY):
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.getLogger("dropbot").info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import logging
+import pathlib
+import re
+
+
+MIGRATIONS_PATH = pathlib.Path(__file__).parent / "migrations"
+
+# arbitrary key so concurrent bot processes don't apply the same migration twice
+MIGRATION_LOCK = 0x5a17a
+
+
+def discover_migrations(path=MIGRATIONS_PATH):
+    migrations = []
+    for file in sorted(path.glob("*.sql")):
+        match = re.match(r"(\d+)_(\w+)\.sql$", file.name)
+        if match is None:
+            continue
+        migrations.append((int(match.group(1)), match.group(2), file))
+    return migrations
+
+
+async def apply_migrations(pool, path=MIGRATIONS_PATH, logger=None):
+    logger = logger or logging.getLogger("dropbot")
+
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK)
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                """)
+            applied = {record['version'] for record in await conn.fetch("SELECT version FROM schema_migrations")}
+
+            for version, name, file in discover_migrations(path):
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(file.read_text(encoding="utf-8"))
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                logger.info(f"Applied migration {version:04} ({name}).")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
@@ -1,5 +1,3 @@
--- TODO: this
-
 CREATE TABLE IF NOT EXISTS user_data (
     user_id BIGINT PRIMARY KEY,
 
@@ -0,0 +1,19 @@
+-- Only the newest active gift per user survives, older duplicates were unreachable anyway.
+UPDATE gifts
+SET active = FALSE
+WHERE active AND id NOT IN (
+    SELECT MAX(id)
+    FROM gifts
+    WHERE active
+    GROUP BY user_id
+);
+
+-- Serves every guess, drop and giveup lookup and enforces one active gift per user.
+CREATE UNIQUE INDEX IF NOT EXISTS gifts_active_user_id_idx ON gifts (user_id) WHERE active;
+
+-- Keeps ON DELETE CASCADE from scanning gifts when a target is reset.
+CREATE INDEX IF NOT EXISTS gifts_target_user_id_idx ON gifts (target_user_id);
+
+CREATE INDEX IF NOT EXISTS user_data_gifts_sent_idx ON user_data (gifts_sent DESC);
+
+CREATE INDEX IF NOT EXISTS user_data_gifts_received_idx ON user_data (gifts_received DESC);
@@ -0,0 +1,28 @@
+-- Settled gifts are moved here so the live table only holds what the bot still reads.
+CREATE TABLE IF NOT EXISTS gifts_archive (
+    id INT PRIMARY KEY,
+
+    user_id BIGINT NOT NULL,
+
+    target_user_id BIGINT NOT NULL,
+
+    activated_date TIMESTAMP,
+
+    archived_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS gifts_archive_user_id_idx ON gifts_archive (user_id);
+
+CREATE OR REPLACE FUNCTION archive_gifts() RETURNS INT AS $$
+    WITH moved AS (
+        DELETE FROM gifts
+        WHERE NOT active
+        RETURNING id, user_id, target_user_id, activated_date
+    ), archived AS (
+        INSERT INTO gifts_archive (id, user_id, target_user_id, activated_date)
+        SELECT id, user_id, target_user_id, activated_date FROM moved
+        ON CONFLICT (id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INT FROM archived;
+$$ LANGUAGE SQL;
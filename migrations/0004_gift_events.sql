@@ -0,0 +1,18 @@
+-- Append-only history of every gift, kept apart from the live tables so reporting never touches them.
+-- No foreign keys: events outlive the participants they mention.
+CREATE TABLE IF NOT EXISTS gift_events (
+    id BIGSERIAL PRIMARY KEY,
+
+    kind TEXT NOT NULL CHECK (kind IN ('drop', 'retry', 'solve', 'giveup', 'reset')),
+
+    user_id BIGINT NOT NULL,
+
+    target_user_id BIGINT,
+
+    occurred_at TIMESTAMP NOT NULL,
+
+    solve_seconds DOUBLE PRECISION
+);
+
+-- Rows arrive in time order, a BRIN index covers range exports at a fraction of a btree's size.
+CREATE INDEX IF NOT EXISTS gift_events_occurred_at_idx ON gift_events USING BRIN (occurred_at);
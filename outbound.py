@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import itertools
+import logging
+import time
+
+import discord
+
+from metrics import Gauge, Histogram
+
+
+PRIORITY_DM = 0
+PRIORITY_ROLE = 1
+PRIORITY_LOG = 2
+
+PRIORITY_NAMES = {PRIORITY_DM: "dm", PRIORITY_ROLE: "role", PRIORITY_LOG: "log"}
+
+MESSAGE_LIMIT = 2000
+
+
+DISCORD_SEND_SECONDS = Histogram("dropbot_discord_send_seconds", "Duration of outbound Discord calls", ["priority"])
+OUTBOX_DEPTH = Gauge("dropbot_outbox_depth", "Outbound Discord calls waiting to be sent")
+
+Job = collections.namedtuple("Job", "priority sequence factory future enqueued")
+
+
+def chunk_lines(lines, limit=MESSAGE_LIMIT):
+    """Join ``lines`` into as few messages of at most ``limit`` characters as they fit in."""
+    chunk = []
+    length = 0
+    for line in lines:
+        if chunk and length + len(line) + 1 > limit:
+            yield "\n".join(chunk)
+            chunk = []
+            length = 0
+        chunk.append(line)
+        length += len(line) + 1
+    if chunk:
+        yield "\n".join(chunk)
+
+
+class Outbox:
+    """Schedules outbound Discord calls instead of making them inline.
+
+    Every call belongs to a route (a user's DMs, a channel, a member's roles). Calls on one route
+    are sent in order, routes are served by priority, and no more than ``concurrency`` calls are
+    in flight at once, so a burst queues here instead of piling up on Discord's rate limits.
+    """
+
+    def __init__(self, bot, concurrency=4, announce_window=3.0, announce_burst=5):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.announce_window = announce_window
+        self.announce_burst = announce_burst
+        self.logger = logging.getLogger("dropbot.outbound")
+
+        self._routes = {}
+        self._scheduled = set()
+        self._ready = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._workers = []
+
+        self._announcements = {}
+        self._announce_times = collections.deque()
+
+        self.sent = collections.Counter()
+        self.failed = collections.Counter()
+        self.latency_total = collections.Counter()
+        self.latency_max = {}
+
+        OUTBOX_DEPTH.set_function(lambda: self.depth)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [self.bot.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    @property
+    def depth(self):
+        return sum(len(jobs) for jobs in self._routes.values())
+
+    def submit(self, route, factory, priority=PRIORITY_DM):
+        """Queue ``factory()`` (a coroutine function) on ``route`` and return a future for its result."""
+        future = self.bot.loop.create_future()
+        # failures are already logged by the worker, nobody has to retrieve them
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        job = Job(priority, next(self._sequence), factory, future, time.perf_counter())
+        self._routes.setdefault(route, collections.deque()).append(job)
+        if route not in self._scheduled:
+            self._scheduled.add(route)
+            self._ready.put_nowait((job.priority, job.sequence, route))
+        return future
+
+    def send(self, destination, content=None, *, priority=PRIORITY_DM, **kwargs):
+        if isinstance(destination, discord.abc.User):
+            route = ("user", destination.id)
+        else:
+            route = ("channel", destination.id)
+        return self.submit(route, lambda: destination.send(content, **kwargs), priority)
+
+    def send_to_channel(self, channel_id, content, *, priority=PRIORITY_LOG):
+        async def send():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                self.logger.warning(f"Could not find channel {channel_id} to send to.")
+                return None
+            return await channel.send(content)
+
+        return self.submit(("channel", channel_id), send, priority)
+
+    def announce(self, channel_id, line):
+        """Post a line to a log channel, merging lines into one message while traffic is high."""
+        now = time.monotonic()
+        self._announce_times.append(now)
+        while self._announce_times and now - self._announce_times[0] > self.announce_window:
+            self._announce_times.popleft()
+
+        if channel_id in self._announcements:
+            self._announcements[channel_id].append(line)
+        elif len(self._announce_times) > self.announce_burst:
+            self._announcements[channel_id] = [line]
+            self.bot.loop.call_later(self.announce_window, self._flush_announcements, channel_id)
+        else:
+            self.send_to_channel(channel_id, line)
+
+    def _flush_announcements(self, channel_id):
+        for chunk in chunk_lines(self._announcements.pop(channel_id, [])):
+            self.send_to_channel(channel_id, chunk)
+
+    async def _worker(self):
+        while True:
+            _, _, route = await self._ready.get()
+            jobs = self._routes[route]
+            job = jobs.popleft()
+
+            try:
+                if not job.future.cancelled():
+                    with DISCORD_SEND_SECONDS.time(priority=PRIORITY_NAMES[job.priority]):
+                        result = await job.factory()
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                self.failed[job.priority] += 1
+                self.logger.warning(f"Outbound call on {route} failed: {exception!r}")
+                if not job.future.done():
+                    job.future.set_exception(exception)
+            else:
+                self.sent[job.priority] += 1
+            finally:
+                latency = time.perf_counter() - job.enqueued
+                self.latency_total[job.priority] += latency
+                self.latency_max[job.priority] = max(self.latency_max.get(job.priority, 0), latency)
+
+                if jobs:
+                    self._ready.put_nowait((jobs[0].priority, jobs[0].sequence, route))
+                else:
+                    del self._routes[route]
+                    self._scheduled.discard(route)
+                self._ready.task_done()
+
+    def stats(self):
+        depth = collections.Counter()
+        for jobs in self._routes.values():
+            for job in jobs:
+                depth[job.priority] += 1
+
+        stats = {}
+        for priority, name in PRIORITY_NAMES.items():
+            done = self.sent[priority] + self.failed[priority]
+            stats[name] = {
+                "depth": depth[priority],
+                "sent": self.sent[priority],
+                "failed": self.failed[priority],
+                "mean_latency": self.latency_total[priority] / done if done else 0.0,
+                "max_latency": self.latency_max.get(priority, 0.0),
+            }
+        return stats
+
+    async def close(self, timeout=10):
+        for channel_id in list(self._announcements):
+            self._flush_announcements(channel_id)
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Closing with {self.depth} outbound calls still queued.")
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+
+import discord
+
+from metrics import Counter, Gauge
+from outbound import PRIORITY_ROLE
+
+
+REWARD_GRANTS = Counter("dropbot_reward_grants_total", "Reward role grants by outcome", ["result"])
+REWARDS_PENDING = Gauge("dropbot_rewards_pending", "Participants waiting for their reward roles to be checked")
+
+
+def earned_roles(rewards, gifts_sent, gifts_received):
+    """Role ids for every threshold reached, so a jump past several thresholds earns all of them."""
+    totals = {"gifts_sent": gifts_sent, "gifts_received": gifts_received}
+    return {role_id for column, thresholds in rewards.items()
+            for threshold, role_id in thresholds if totals[column] >= threshold}
+
+
+class RewardReconciler:
+    """Brings members' reward roles in line with their gift totals, in periodic batches.
+
+    Scores only note the participant's latest totals. Every ``interval`` seconds up to ``budget``
+    members are resolved in the configured reward guild and given every earned role they lack in a
+    single call through the outbox. Whoever is left over, or failed, waits for the next round, so a
+    burst of scores becomes a steady trickle of role updates.
+    """
+
+    def __init__(self, bot, interval=10.0, budget=10):
+        self.bot = bot
+        self.interval = interval
+        self.budget = budget
+        self.logger = logging.getLogger("dropbot.rewards")
+
+        self._pending = {}
+        self._task = None
+
+        REWARDS_PENDING.set_function(lambda: len(self._pending))
+
+    def start(self):
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def note(self, user_id, gifts_sent, gifts_received):
+        if earned_roles(self.bot.config.rewards, gifts_sent, gifts_received):
+            self._pending[user_id] = (gifts_sent, gifts_received)
+
+    def forget(self, predicate):
+        for user_id in [user_id for user_id in self._pending if predicate(user_id)]:
+            del self._pending[user_id]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception("Reward reconciliation failed, retrying next round.")
+
+    async def reconcile(self):
+        if not self._pending:
+            return
+
+        guild = self.bot.get_guild(self.bot.config.reward_guild or 0)
+        if guild is None:
+            if self.bot.is_ready():
+                # the reward guild is served by another shard process, which reconciles on its own
+                self._pending.clear()
+            return
+
+        batch = list(self._pending.items())[:self.budget]
+        for user_id, _ in batch:
+            del self._pending[user_id]
+
+        grants = []
+        for user_id, (gifts_sent, gifts_received) in batch:
+            member = guild.get_member(user_id)
+            if member is None:
+                try:
+                    member = await guild.fetch_member(user_id)
+                except discord.NotFound:
+                    continue
+                except discord.HTTPException:
+                    self._pending.setdefault(user_id, (gifts_sent, gifts_received))
+                    continue
+
+            owned = {role.id for role in member.roles}
+            missing = [role for role in map(guild.get_role, earned_roles(self.bot.config.rewards, gifts_sent,
+                                                                         gifts_received) - owned) if role]
+            if missing:
+                grants.append((member, missing, (gifts_sent, gifts_received)))
+
+        results = await asyncio.gather(*(self._grant(member, roles) for member, roles, _ in grants),
+                                       return_exceptions=True)
+        for (member, roles, totals), result in zip(grants, results):
+            if isinstance(result, Exception):
+                REWARD_GRANTS.inc(result="failed")
+                self.logger.warning(f"Failed to add reward roles {[role.id for role in roles]} to {member.id}: "
+                                    f"{result!r}")
+                if not isinstance(result, discord.Forbidden):
+                    self._pending.setdefault(member.id, totals)
+            else:
+                REWARD_GRANTS.inc(len(roles), result="granted")
+
+    def _grant(self, member, roles):
+        reason = "Reached " + ", ".join(role.name for role in roles)
+        return self.bot.outbox.submit(("roles", member.id), lambda: member.add_roles(*roles, reason=reason),
+                                      priority=PRIORITY_ROLE)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import csv
+import pathlib
+from datetime import datetime
+
+from events import EXPORT_PATH
+
+
+NICKNAME_LIMIT = 32
+
+# add_dummy and delete_dummies treat ids up to this one as dummies
+DUMMY_ID_LIMIT = 10000
+
+
+def parse_roster(lines):
+    """Read a CSV roster into tuples in PARTICIPANT_COLUMNS order.
+
+    ``user_id`` and ``nickname`` are required, ``gifts_sent``, ``gifts_received`` and ``last_gift``
+    are optional, so a ``user_data`` export can be imported as it is.
+    """
+    reader = csv.DictReader(lines)
+    missing = {"user_id", "nickname"} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"Roster is missing the {', '.join(sorted(missing))} column")
+
+    records = []
+    for row in reader:
+        try:
+            nickname = row["nickname"].strip()
+            if not 0 < len(nickname) <= NICKNAME_LIMIT:
+                raise ValueError(f"nickname must be 1 to {NICKNAME_LIMIT} characters")
+            records.append((
+                int(row["user_id"]),
+                nickname,
+                int(row.get("gifts_sent") or 0),
+                int(row.get("gifts_received") or 0),
+                datetime.fromisoformat(row["last_gift"]) if row.get("last_gift") else None,
+            ))
+        except ValueError as exception:
+            raise ValueError(f"Line {reader.line_num}: {exception}") from None
+    return records
+
+
+def dummy_roster(count, start=1):
+    if start < 1 or start + count - 1 > DUMMY_ID_LIMIT:
+        raise ValueError(f"Dummy ids have to stay within 1-{DUMMY_ID_LIMIT}")
+    return [(user_id, f"Dummy{user_id}", 0, 0, None) for user_id in range(start, start + count)]
+
+
+async def export_roster(storage, directory=EXPORT_PATH):
+    """Dump ``user_data`` and ``gifts`` to timestamped CSVs in ``directory``, returns (path, rows) pairs."""
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = f"{datetime.utcnow():%Y%m%dT%H%M%S}"
+
+    exported = []
+    for table in ("user_data", "gifts"):
+        path = directory / f"{table}-{stamp}.csv"
+        exported.append((path, await storage.export_table(table, path)))
+    return exported
@@ -2,11 +2,10 @@
 import asyncio
 
 import logging
-import sys
-
-import toml
 
 from bot import DropBot
+from config import Config
+from logs import setup_logging
 
 try:
     import uvloop
@@ -16,22 +15,12 @@ else:
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
+config = Config.load()
+
 logging.getLogger('discord').setLevel(logging.INFO)
 logging.getLogger('dropbot').setLevel(logging.DEBUG)
 
-formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
-
-handler = logging.FileHandler(filename='dropbot.log', encoding='utf-8', mode='a')
-handler.setFormatter(formatter)
-
-stream = logging.StreamHandler(stream=sys.stdout)
-stream.setFormatter(formatter)
-
-logging.getLogger().addHandler(handler)
-logging.getLogger().addHandler(stream)
-
-with open('config.toml', 'r', encoding='utf-8') as fp:
-    config = toml.load(fp)
+setup_logging(config.get("logging"))
 
 token = config["token"]
 
@@ -40,4 +29,5 @@ bot = DropBot('.', config=config)
 
 bot.load_extension("jishaku")
 bot.load_extension("cogs.coindrop")
+bot.load_extension("cogs.admin")
 bot.run(token)
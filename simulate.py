@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""Load simulator for the CoinDrop cog.
+
+Drives ``CoinDrop.on_message`` and the gift commands with fake Discord objects at configurable
+rates against the database configured in config.toml (or in-memory storage with ``--storage memory``),
+then reports throughput, latency and pool saturation. No Discord login happens, outbound messages
+are delivered to the fakes after ``--send-latency`` seconds. Running the same workload against both
+backends shows how much of the latency is spent in Postgres.
+
+    python simulate.py --users 2000 --duration 60 --messages 200 --guesses 50 --accuracy 0.3
+    python simulate.py --users 2000 --duration 60 --storage memory
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import logging
+import random
+import re
+import string
+import time
+from datetime import datetime
+
+import toml
+
+import discord
+
+from bot import DropBot
+from metrics import POOL_IN_USE, REGISTRY
+
+
+# far outside the range of real snowflakes and dummies, so the run can clean up after itself
+USER_ID_BASE = 1 << 60
+CHANNEL_ID_BASE = USER_ID_BASE + (1 << 40)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild, sim):
+        self.id = channel_id
+        self.guild = guild
+        self.sim = sim
+
+    async def send(self, content=None, **kwargs):
+        await self.sim.deliver(self, content, kwargs)
+
+
+class FakeDMChannel(discord.DMChannel):
+    # skips DMChannel.__init__, which needs a connection state
+    def __init__(self, recipient):
+        self.id = recipient.id
+        self.recipient = recipient
+        self.me = None
+
+    async def send(self, content=None, **kwargs):
+        await self.recipient.send(content, **kwargs)
+
+
+class FakePermissions:
+    ban_members = False
+
+
+class FakeUser:
+    bot = False
+    nick = None
+    guild_permissions = FakePermissions()
+
+    def __init__(self, user_id, name, sim):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{user_id}>"
+        self.guild = None
+        self.sim = sim
+
+    async def send(self, content=None, **kwargs):
+        await self.sim.deliver(self, content, kwargs)
+
+    async def add_roles(self, *roles, reason=None):
+        await self.sim.deliver(self, None, {"roles": roles})
+
+
+class FakeMessage:
+    _ids = itertools.count(CHANNEL_ID_BASE)
+
+    def __init__(self, author, content, channel, guild=None):
+        self.id = next(self._ids)
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.guild = guild
+        self.created_at = datetime.utcnow()
+
+    async def delete(self):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeContext:
+    def __init__(self, bot, message):
+        self.bot = bot
+        self.message = message
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        # the user only sees a reply once it has been delivered
+        await self.author.sim.deliver(self.channel, content, kwargs)
+        self.replies.append(content)
+
+
+class Simulation:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.cog = None
+        self.guild = FakeGuild(CHANNEL_ID_BASE)
+        self.channels = [FakeChannel(CHANNEL_ID_BASE + index, self.guild, self) for index in range(args.channels)]
+        self.log_channel = FakeChannel(CHANNEL_ID_BASE + args.channels, self.guild, self)
+        self.users = []
+
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.delivered = collections.Counter()
+        self.pool_samples = []
+        self.running = False
+        self.tasks = set()
+
+    def fake_channel(self, channel_id):
+        for channel in self.channels + [self.log_channel]:
+            if channel.id == channel_id:
+                return channel
+        return None
+
+    async def deliver(self, destination, content, kwargs):
+        await asyncio.sleep(self.args.send_latency)
+        if kwargs.get("roles"):
+            self.delivered["roles"] += 1
+        elif destination is self.log_channel:
+            self.delivered["log"] += 1
+        else:
+            self.delivered["dm" if isinstance(destination, FakeUser) else "channel"] += 1
+
+    async def timed(self, kind, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception:
+            self.errors[kind] += 1
+            logging.getLogger("dropbot.simulate").exception(f"Simulated {kind} failed")
+        finally:
+            self.latencies[kind].append(time.perf_counter() - start)
+
+    def spawn(self, kind, coro):
+        task = self.bot.loop.create_task(self.timed(kind, coro))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def setup(self):
+        await asyncio.wait_for(self.bot.warmed_up.wait(), timeout=30)
+        self.cog = self.bot.get_cog("CoinDrop")
+
+        await self.cleanup()
+        letters = string.ascii_letters
+        for index in range(self.args.users):
+            name = "Sim" + "".join(random.choice(letters) for _ in range(12))
+            user = FakeUser(USER_ID_BASE + index, name, self)
+            self.users.append(user)
+
+        start = time.perf_counter()
+        for batch in range(0, len(self.users), 100):
+            await asyncio.gather(*(self.join(user) for user in self.users[batch:batch + 100]))
+        print(f"Joined {len(self.users)} users in {time.perf_counter() - start:.2f}s")
+
+    async def join(self, user):
+        channel = random.choice(self.channels)
+        ctx = FakeContext(self.bot, FakeMessage(user, f".join {user.name}", channel, self.guild))
+        await self.timed("join", self.cog.join_command.callback(self.cog, ctx, nickname=user.name))
+
+    async def cleanup(self):
+        await self.bot.storage.delete_participants(USER_ID_BASE, CHANNEL_ID_BASE)
+        if self.cog is not None:
+            self.cog.forget_users(lambda user_id: USER_ID_BASE <= user_id < CHANNEL_ID_BASE)
+
+    def chatter(self):
+        user = random.choice(self.users)
+        content = " ".join(random.choice(("hello", "blobs", "presents", "snow", "festive")) for _ in range(4))
+        message = FakeMessage(user, content, random.choice(self.channels), self.guild)
+        self.spawn("message", self.cog.on_message(message))
+
+    def guess(self):
+        gifters = [user for user in self.users if user.id in self.cog.current_gifters]
+        if not gifters:
+            return
+        user = random.choice(gifters)
+        gift = self.cog.gift_index.get(user.id)
+        if gift is not None and random.random() < self.args.accuracy:
+            content = self.cog.roster.nickname(gift.target_user_id) or "unknown"
+        else:
+            content = "Wrong" + "".join(random.choice(string.ascii_lowercase) for _ in range(6))
+        message = FakeMessage(user, content, FakeDMChannel(user))
+        self.spawn("guess", self.cog.on_message(message))
+
+    def giveup(self):
+        gifters = [user for user in self.users if user.id in self.cog.current_gifters]
+        if gifters:
+            self.spawn("giveup", self.run_giveup(random.choice(gifters)))
+
+    async def run_giveup(self, user):
+        channel = FakeDMChannel(user)
+        ctx = FakeContext(self.bot, FakeMessage(user, ".giveup", channel))
+        command = self.bot.loop.create_task(self.cog.giveup_command.callback(self.cog, ctx))
+
+        # answer the confirmation prompt as soon as it shows up and the command is waiting for it
+        while not command.done():
+            for reply in ctx.replies:
+                match = re.search(r"'(confirm \d+)'", reply or "")
+                if match and self.answer_prompt(FakeMessage(user, match.group(1), channel)):
+                    return await command
+            await asyncio.sleep(0.01)
+        await command
+
+    def answer_prompt(self, message):
+        """Hand ``message`` to the ``wait_for`` expecting it.
+
+        Dispatching it would also run it through on_message and command processing, which the fakes
+        can't go through.
+        """
+        listeners = self.bot._listeners.get("message", [])
+        for listener in list(listeners):
+            future, check = listener
+            if not future.done() and check(message):
+                future.set_result(message)
+                listeners.remove(listener)
+                return True
+        return False
+
+    async def drive(self, rate, action):
+        while self.running:
+            await asyncio.sleep(random.expovariate(rate))
+            action()
+
+    async def sample_pool(self):
+        while self.running:
+            self.pool_samples.append(POOL_IN_USE.get())
+            await asyncio.sleep(0.05)
+
+    async def run(self):
+        drivers = []
+        self.running = True
+        for rate, action in ((self.args.messages, self.chatter),
+                             (self.args.guesses, self.guess),
+                             (self.args.giveups, self.giveup)):
+            if rate > 0:
+                drivers.append(self.bot.loop.create_task(self.drive(rate, action)))
+        drivers.append(self.bot.loop.create_task(self.sample_pool()))
+
+        await asyncio.sleep(self.args.duration)
+        self.running = False
+        await asyncio.gather(*drivers)
+
+        start = time.perf_counter()
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=30)
+        await self.bot.tasks.join(timeout=30)
+        drained = time.perf_counter() - start
+
+        self.report(self.args.duration, drained)
+
+    def report(self, elapsed, drained):
+        # rates are over the workload's duration, the drain afterwards only lets operations finish
+        print(f"\nSimulated {elapsed:.1f}s with {len(self.users)} users over {len(self.channels)} channels, "
+              f"{drained:.1f}s to drain")
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            count = len(latencies)
+            p50 = latencies[int(count * .5)]
+            p99 = latencies[min(count - 1, int(count * .99))]
+            print(f"  {kind:>8}: {count:7} ops {count / elapsed:9.1f}/s  p50 {p50 * 1000:8.2f}ms  "
+                  f"p99 {p99 * 1000:8.2f}ms  errors {self.errors[kind]}")
+
+        max_size = self.args.pool_size
+        if self.pool_samples and self.bot.db is not None:
+            saturated = sum(1 for sample in self.pool_samples if sample >= max_size) / len(self.pool_samples)
+            print(f"  pool: max {max(self.pool_samples)}/{max_size} in use, saturated {saturated:.1%} of the time")
+        print(f"  delivered: {dict(self.delivered)}")
+        print(f"  drop gate skips: {dict(self.cog.drop_gate.skipped)}")
+        print("\n".join(f"  {line}" for line in REGISTRY.snapshot() if line.startswith("dropbot_")))
+
+
+async def main(bot, args):
+    sim = Simulation(bot, args)
+    bot.get_channel = sim.fake_channel
+    try:
+        await sim.setup()
+        await sim.run()
+    finally:
+        if not args.keep:
+            await sim.cleanup()
+        await bot.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="config.toml")
+    parser.add_argument("--users", type=int, default=1000, help="participants to join before the run")
+    parser.add_argument("--channels", type=int, default=3, help="drop channels to spread chatter over")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run the workload for")
+    parser.add_argument("--messages", type=float, default=100, help="channel messages per second")
+    parser.add_argument("--guesses", type=float, default=20, help="DM guesses per second")
+    parser.add_argument("--accuracy", type=float, default=0.5, help="share of guesses that are correct")
+    parser.add_argument("--giveups", type=float, default=0.5, help="giveups per second")
+    parser.add_argument("--drops-per-minute", type=float, default=None, help="override drops_per_minute")
+    parser.add_argument("--cooldown", type=float, default=None, help="override cooldown_time")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="simulated Discord send latency")
+    parser.add_argument("--storage", choices=("postgres", "memory"), default=None,
+                        help="override the storage backend from the config")
+    parser.add_argument("--keep", action="store_true", help="keep the simulated users afterwards")
+    return parser.parse_args()
+
+
+def build_bot(args):
+    with open(args.config, 'r', encoding='utf-8') as fp:
+        config = toml.load(fp)
+
+    config.pop("token", None)
+    config["drop_channels"] = [CHANNEL_ID_BASE + index for index in range(args.channels)]
+    config["present_log"] = CHANNEL_ID_BASE + args.channels
+    config.pop("metrics_port", None)
+    if args.drops_per_minute is not None:
+        config["drops_per_minute"] = args.drops_per_minute
+    if args.cooldown is not None:
+        config["cooldown_time"] = args.cooldown
+    if args.storage is not None:
+        config["storage"] = args.storage
+
+    args.pool_size = config.get("database", {}).get("max_size", 10)
+    bot = DropBot('.', config=config)
+    bot.load_extension("cogs.coindrop")
+    return bot
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    arguments = parse_args()
+    dropbot = build_bot(arguments)
+    dropbot.loop.run_until_complete(main(dropbot, arguments))
@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import uuid
+from datetime import datetime
+
+import asyncpg
+
+
+LEADERBOARD_COLUMNS = ("gifts_sent", "gifts_received")
+
+NOTIFY_CHANNEL = "dropbot_events"
+# Postgres rejects NOTIFY payloads longer than this many bytes
+NOTIFY_PAYLOAD_LIMIT = 8000
+# user ids are snowflakes of at most 20 digits, 22 bytes each with the ", " between them in the JSON list,
+# and 1000 bytes are left for the rest of the payload
+FORGET_IDS_PER_NOTIFY = (NOTIFY_PAYLOAD_LIMIT - 1000) // 22
+
+EVENT_COLUMNS = ("kind", "user_id", "target_user_id", "occurred_at", "solve_seconds")
+
+PARTICIPANT_COLUMNS = ("user_id", "nickname", "gifts_sent", "gifts_received", "last_gift")
+
+GIFT_COLUMNS = ("id", "user_id", "target_user_id", "active", "activated_date")
+
+EXPORT_TABLES = {"user_data": PARTICIPANT_COLUMNS, "gifts": GIFT_COLUMNS}
+
+
+class Rollback(Exception):
+    pass
+
+
+class StorageConflict(Exception):
+    """A write would break a uniqueness rule (user id or nickname already taken)."""
+
+
+class Storage:
+    """Everything the bot persists, independent of where it is kept.
+
+    Records are returned as mappings with the column names of the Postgres schema, so callers can
+    index asyncpg records and in-memory rows the same way.
+    """
+
+    async def load_participants(self):
+        """Every participant's user_id, nickname, gifts_sent, gifts_received and last_gift."""
+        raise NotImplementedError
+
+    async def load_active_gifts(self):
+        """Every active gift's user_id, target_user_id, target nickname and issued_at."""
+        raise NotImplementedError
+
+    async def get_participant(self, user_id):
+        raise NotImplementedError
+
+    async def join(self, user_id, nickname, fallback_nickname):
+        """Add a participant. If the nickname is taken, the holder is renamed to ``fallback_nickname``
+        and their row is returned instead, as the ON CONFLICT clause in the schema does."""
+        raise NotImplementedError
+
+    async def get_active_gift(self, user_id):
+        """The target's user_id and nickname for the user's active gift, or None."""
+        raise NotImplementedError
+
+    async def has_active_gift(self, user_id):
+        raise NotImplementedError
+
+    async def create_gift(self, user_id, target_user_id, when, first_attempt):
+        """Stamp last_gift and, on a first attempt, insert the gift. False if one was already active."""
+        raise NotImplementedError
+
+    async def settle_gifts(self, solves):
+        """Settle a mapping of user_id -> solve time, see PostgresStorage.settle_gifts for the result."""
+        raise NotImplementedError
+
+    async def give_up(self, user_id):
+        """Delete the user's active gift and return the target's nickname, or None."""
+        raise NotImplementedError
+
+    async def leaderboard(self, column, limit):
+        raise NotImplementedError
+
+    async def roster(self):
+        """Every participant's nickname, gifts_sent and gifts_received, ordered by nickname."""
+        raise NotImplementedError
+
+    async def delete_participant(self, user_id):
+        raise NotImplementedError
+
+    async def delete_participants(self, low, high):
+        """Delete every participant with ``low <= user_id < high``, cascading to their gifts."""
+        raise NotImplementedError
+
+    async def delete_participant_ids(self, user_ids):
+        """Delete the given participants in one go, returns the ids that existed."""
+        raise NotImplementedError
+
+    async def import_participants(self, records):
+        """Bulk insert tuples in PARTICIPANT_COLUMNS order.
+
+        Rows whose user_id or nickname is already taken are skipped rather than renamed, the inserted
+        participants are returned.
+        """
+        raise NotImplementedError
+
+    async def export_table(self, table, output):
+        """Write ``user_data`` or ``gifts`` to ``output`` as CSV with a header, return the row count."""
+        raise NotImplementedError
+
+    async def archive_gifts(self):
+        raise NotImplementedError
+
+    async def record_events(self, events):
+        """Append a batch of tuples in EVENT_COLUMNS order to the gift event log."""
+        raise NotImplementedError
+
+    async def export_events(self, output, since=None, until=None):
+        """Write the gift events in ``[since, until)`` to ``output`` as CSV with a header, return the row count."""
+        raise NotImplementedError
+
+    async def publish(self, event, data):
+        """Tell the other processes sharing this storage that ``event`` happened. No-op by default."""
+
+    async def publish_forget_ids(self, user_ids):
+        """Publish ``forget_ids`` for ``user_ids``, split so every payload fits in a notification."""
+        user_ids = list(user_ids)
+        for start in range(0, len(user_ids), FORGET_IDS_PER_NOTIFY):
+            await self.publish("forget_ids", {'user_ids': user_ids[start:start + FORGET_IDS_PER_NOTIFY]})
+
+    async def listen(self, callback):
+        """Call ``callback(event, data)`` for every event published by another process, until cancelled.
+
+        ``callback("resync", {})`` is sent whenever events may have been missed.
+        """
+
+    async def close(self):
+        pass
+
+
+# parsed and planned once per connection, then reused from asyncpg's statement cache, see create_pool
+STATEMENTS = {
+    'get_participant': """
+        SELECT user_id, nickname, gifts_sent, gifts_received, last_gift FROM user_data WHERE user_id = $1
+        """,
+    'join': """
+        INSERT INTO user_data (user_id, nickname)
+        VALUES ($1, $2)
+        ON CONFLICT (nickname) DO UPDATE
+        SET nickname = $3
+        RETURNING user_id, nickname, gifts_sent, gifts_received, last_gift
+        """,
+    'get_active_gift': """
+        SELECT nickname, user_data.user_id
+        FROM gifts
+        INNER JOIN user_data
+        ON target_user_id = user_data.user_id
+        WHERE gifts.user_id = $1 AND active
+        """,
+    'has_active_gift': """
+        SELECT EXISTS (
+        SELECT 1
+        FROM gifts
+        WHERE active = TRUE and user_id = $1
+        )
+        """,
+    'stamp_last_gift': """
+        UPDATE user_data
+        SET last_gift = $2
+        WHERE user_id = $1
+        """,
+    'insert_gift': """
+        INSERT INTO gifts (user_id, target_user_id)
+            VALUES ($1, $2)
+        ON CONFLICT (user_id) WHERE active DO NOTHING
+        RETURNING id
+        """,
+    'settle_gifts': """
+        WITH solved AS (
+            UPDATE gifts
+            SET active = FALSE
+            FROM unnest($1::BIGINT[], $2::TIMESTAMP[]) AS solve(user_id, solved_at)
+            WHERE gifts.user_id = solve.user_id AND active
+            RETURNING gifts.user_id, gifts.target_user_id, solve.solved_at
+        ), deltas AS (
+            SELECT user_id, 1 AS sent, 0 AS received, solved_at FROM solved
+            UNION ALL
+            SELECT target_user_id, 0, 1, NULL FROM solved
+        ), totals AS (
+            SELECT user_id, SUM(sent) AS sent, SUM(received) AS received, MAX(solved_at) AS solved_at
+            FROM deltas
+            GROUP BY user_id
+        ), updated AS (
+            UPDATE user_data
+            SET gifts_sent = gifts_sent + totals.sent,
+                gifts_received = gifts_received + totals.received,
+                last_gift = COALESCE(totals.solved_at, last_gift)
+            FROM totals
+            WHERE user_data.user_id = totals.user_id
+            RETURNING user_data.user_id, nickname, gifts_sent, gifts_received
+        )
+        SELECT solved.user_id, sender.nickname, sender.gifts_sent, sender.gifts_received,
+               solved.target_user_id, target.nickname AS target_nickname,
+               target.gifts_sent AS target_gifts_sent, target.gifts_received AS target_gifts_received
+        FROM solved
+        INNER JOIN updated AS sender
+        ON solved.user_id = sender.user_id
+        INNER JOIN updated AS target
+        ON solved.target_user_id = target.user_id
+        """,
+    'give_up': """
+        WITH removed AS (
+            DELETE FROM gifts
+            WHERE active = TRUE AND user_id = $1
+            RETURNING target_user_id
+        )
+        SELECT nickname
+        FROM removed
+        INNER JOIN user_data
+        ON target_user_id = user_data.user_id
+        """,
+    'roster': """
+        SELECT nickname, gifts_sent, gifts_received FROM user_data
+        ORDER BY
+        nickname ASC
+        """,
+}
+
+STATEMENTS.update({f'leaderboard_{column}': f"""
+    SELECT user_id, nickname, {column} FROM user_data
+    ORDER BY {column} DESC
+    LIMIT $1
+    """ for column in LEADERBOARD_COLUMNS})
+
+
+async def create_pool(credentials):
+    """Open the pool for PostgresStorage.
+
+    STATEMENTS are passed to ``fetch`` and friends as plain query strings. asyncpg keeps a prepared
+    copy per connection in its statement cache and reuses it on every later checkout. Statements
+    prepared by hand would be invalidated the first time their connection goes back to the pool.
+    """
+    return await asyncpg.create_pool(**credentials)
+
+
+class PostgresStorage(Storage):
+    def __init__(self, pool, notify=False):
+        self.pool = pool
+        self.notify = notify
+        self.origin = uuid.uuid4().hex
+        self.logger = logging.getLogger("dropbot.storage")
+
+    async def load_participants(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("SELECT user_id, nickname, gifts_sent, gifts_received, last_gift FROM user_data")
+
+    async def load_active_gifts(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(
+                """
+                SELECT gifts.user_id, target_user_id, target.nickname, sender.last_gift AS issued_at
+                FROM gifts
+                INNER JOIN user_data AS target
+                ON target_user_id = target.user_id
+                INNER JOIN user_data AS sender
+                ON gifts.user_id = sender.user_id
+                WHERE active
+                """)
+
+    async def get_participant(self, user_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(STATEMENTS['get_participant'], user_id)
+
+    async def join(self, user_id, nickname, fallback_nickname):
+        async with self.pool.acquire() as conn:
+            try:
+                return await conn.fetchrow(STATEMENTS['join'], user_id, nickname, fallback_nickname)
+            except asyncpg.UniqueViolationError as exception:
+                raise StorageConflict(str(exception)) from exception
+
+    async def get_active_gift(self, user_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(STATEMENTS['get_active_gift'], user_id)
+
+    async def has_active_gift(self, user_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(STATEMENTS['has_active_gift'], user_id)
+
+    async def create_gift(self, user_id, target_user_id, when, first_attempt):
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    await conn.fetch(STATEMENTS['stamp_last_gift'], user_id, when)
+                    if first_attempt:
+                        gift_id = await conn.fetchval(STATEMENTS['insert_gift'], user_id, target_user_id)
+                        if gift_id is None:
+                            raise Rollback()
+            except Rollback:
+                return False
+        return True
+
+    async def settle_gifts(self, solves):
+        """Settle every gift in one statement.
+
+        Returns one record per settled gift with the sender's user_id, nickname, gifts_sent and
+        gifts_received, and the target's user_id, nickname and totals (prefixed ``target_``).
+        Senders without an active gift are skipped.
+        """
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(STATEMENTS['settle_gifts'], list(solves.keys()), list(solves.values()))
+
+    async def give_up(self, user_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(STATEMENTS['give_up'], user_id)
+
+    async def leaderboard(self, column, limit):
+        if column not in LEADERBOARD_COLUMNS:
+            raise ValueError(f"Cannot rank by {column}")
+
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(STATEMENTS[f'leaderboard_{column}'], limit)
+
+    async def roster(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(STATEMENTS['roster'])
+
+    async def delete_participant(self, user_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM user_data WHERE user_id = $1", user_id)
+
+    async def delete_participants(self, low, high):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM user_data WHERE user_id >= $1 AND user_id < $2", low, high)
+
+    async def delete_participant_ids(self, user_ids):
+        async with self.pool.acquire() as conn:
+            records = await conn.fetch("DELETE FROM user_data WHERE user_id = ANY($1::BIGINT[]) RETURNING user_id",
+                                       list(user_ids))
+        return [record['user_id'] for record in records]
+
+    async def import_participants(self, records):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # COPY has no ON CONFLICT, so stage the rows and insert what fits in one statement
+                await conn.execute(
+                    "CREATE TEMPORARY TABLE roster_import (LIKE user_data INCLUDING DEFAULTS) ON COMMIT DROP")
+                await conn.copy_records_to_table("roster_import", records=records, columns=PARTICIPANT_COLUMNS)
+                return await conn.fetch(
+                    """
+                    INSERT INTO user_data (user_id, nickname, gifts_sent, gifts_received, last_gift)
+                    SELECT user_id, nickname, COALESCE(gifts_sent, 0), COALESCE(gifts_received, 0),
+                           COALESCE(last_gift, CURRENT_TIMESTAMP)
+                    FROM roster_import
+                    ON CONFLICT DO NOTHING
+                    RETURNING user_id, nickname, gifts_sent, gifts_received, last_gift
+                    """)
+
+    async def export_table(self, table, output):
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Cannot export {table}")
+
+        async with self.pool.acquire() as conn:
+            status = await conn.copy_from_table(table, columns=EXPORT_TABLES[table], output=output,
+                                                format="csv", header=True)
+        return int(status.split()[-1])
+
+    async def archive_gifts(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT archive_gifts()")
+
+    async def record_events(self, events):
+        async with self.pool.acquire() as conn:
+            await conn.copy_records_to_table("gift_events", records=events, columns=EVENT_COLUMNS)
+
+    async def export_events(self, output, since=None, until=None):
+        async with self.pool.acquire() as conn:
+            status = await conn.copy_from_query(
+                f"""
+                SELECT id, {', '.join(EVENT_COLUMNS)}
+                FROM gift_events
+                WHERE ($1::TIMESTAMP IS NULL OR occurred_at >= $1) AND ($2::TIMESTAMP IS NULL OR occurred_at < $2)
+                ORDER BY id
+                """,
+                since,
+                until,
+                output=output,
+                format="csv",
+                header=True
+            )
+        # status is the command tag, "COPY <rows>"
+        return int(status.split()[-1])
+
+    async def publish(self, event, data):
+        if not self.notify:
+            return
+
+        payload = json.dumps({'origin': self.origin, 'event': event, 'data': data}, default=str)
+        async with self.pool.acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, payload)
+
+    async def listen(self, callback):
+        if not self.notify:
+            return
+
+        def on_notification(conn, pid, channel, payload):
+            message = json.loads(payload)
+            if message['origin'] != self.origin:
+                callback(message['event'], message['data'])
+
+        resync = False
+        while True:
+            lost = asyncio.Event()
+            try:
+                # holds one pool connection for as long as the bot runs
+                async with self.pool.acquire() as conn:
+                    conn.add_termination_listener(lambda conn: lost.set())
+                    await conn.add_listener(NOTIFY_CHANNEL, on_notification)
+                    if resync:
+                        callback("resync", {})
+                    try:
+                        await lost.wait()
+                    finally:
+                        if not conn.is_closed():
+                            await conn.remove_listener(NOTIFY_CHANNEL, on_notification)
+            except (OSError, asyncpg.PostgresError) as exception:
+                self.logger.warning(f"Could not listen for notifications: {exception!r}")
+            else:
+                self.logger.warning("Lost the notification connection, listening again.")
+
+            resync = True
+            await asyncio.sleep(1)
+
+    async def close(self):
+        await self.pool.close()
+
+
+class MemoryStorage(Storage):
+    """Dictionary-backed storage with the same semantics as the Postgres schema, for tests and benchmarks."""
+
+    def __init__(self):
+        self._users = {}
+        self._nicknames = {}
+        self._gifts = {}
+        self._active = {}
+        self._archive = {}
+        self._gift_ids = itertools.count(1)
+        self._events = []
+
+    @staticmethod
+    def _participant(user):
+        return {key: user[key] for key in ("user_id", "nickname", "gifts_sent", "gifts_received", "last_gift")}
+
+    async def load_participants(self):
+        return [self._participant(user) for user in self._users.values()]
+
+    async def load_active_gifts(self):
+        return [{'user_id': user_id, 'target_user_id': self._gifts[gift_id]['target_user_id'],
+                 'nickname': self._users[self._gifts[gift_id]['target_user_id']]['nickname'],
+                 'issued_at': self._users[user_id]['last_gift']}
+                for user_id, gift_id in self._active.items()]
+
+    async def get_participant(self, user_id):
+        user = self._users.get(user_id)
+        return None if user is None else self._participant(user)
+
+    async def join(self, user_id, nickname, fallback_nickname):
+        holder = self._nicknames.get(nickname)
+        if holder is not None:
+            if fallback_nickname in self._nicknames and self._nicknames[fallback_nickname] != holder:
+                raise StorageConflict(f"Nickname {fallback_nickname} is already taken")
+            del self._nicknames[nickname]
+            self._nicknames[fallback_nickname] = holder
+            self._users[holder]['nickname'] = fallback_nickname
+            return self._participant(self._users[holder])
+
+        if user_id in self._users:
+            raise StorageConflict(f"User {user_id} has already joined")
+
+        user = {'user_id': user_id, 'nickname': nickname, 'gifts_sent': 0, 'gifts_received': 0,
+                'last_gift': datetime.utcnow()}
+        self._users[user_id] = user
+        self._nicknames[nickname] = user_id
+        return self._participant(user)
+
+    async def get_active_gift(self, user_id):
+        gift_id = self._active.get(user_id)
+        if gift_id is None:
+            return None
+        target = self._users[self._gifts[gift_id]['target_user_id']]
+        return {'nickname': target['nickname'], 'user_id': target['user_id']}
+
+    async def has_active_gift(self, user_id):
+        return user_id in self._active
+
+    async def create_gift(self, user_id, target_user_id, when, first_attempt):
+        if first_attempt:
+            if user_id in self._active:
+                return False
+            if user_id not in self._users or target_user_id not in self._users:
+                raise StorageConflict(f"Gift between unknown users {user_id} and {target_user_id}")
+            gift_id = next(self._gift_ids)
+            self._gifts[gift_id] = {'id': gift_id, 'user_id': user_id, 'target_user_id': target_user_id,
+                                    'active': True, 'activated_date': datetime.utcnow()}
+            self._active[user_id] = gift_id
+
+        if user_id in self._users:
+            self._users[user_id]['last_gift'] = when
+        return True
+
+    async def settle_gifts(self, solves):
+        solved = []
+        for user_id, when in solves.items():
+            gift_id = self._active.pop(user_id, None)
+            if gift_id is None:
+                continue
+            gift = self._gifts[gift_id]
+            gift['active'] = False
+            solved.append((user_id, gift['target_user_id'], when))
+
+        for user_id, target_user_id, when in solved:
+            sender = self._users[user_id]
+            sender['gifts_sent'] += 1
+            sender['last_gift'] = max(sender['last_gift'], when) if sender['last_gift'] else when
+            self._users[target_user_id]['gifts_received'] += 1
+
+        records = []
+        for user_id, target_user_id, _ in solved:
+            sender = self._users[user_id]
+            target = self._users[target_user_id]
+            records.append({
+                'user_id': user_id, 'nickname': sender['nickname'],
+                'gifts_sent': sender['gifts_sent'], 'gifts_received': sender['gifts_received'],
+                'target_user_id': target_user_id, 'target_nickname': target['nickname'],
+                'target_gifts_sent': target['gifts_sent'], 'target_gifts_received': target['gifts_received'],
+            })
+        return records
+
+    async def give_up(self, user_id):
+        gift_id = self._active.pop(user_id, None)
+        if gift_id is None:
+            return None
+        gift = self._gifts.pop(gift_id)
+        return self._users[gift['target_user_id']]['nickname']
+
+    async def leaderboard(self, column, limit):
+        if column not in LEADERBOARD_COLUMNS:
+            raise ValueError(f"Cannot rank by {column}")
+
+        ranked = sorted(self._users.values(), key=lambda user: user[column], reverse=True)[:limit]
+        return [{'user_id': user['user_id'], 'nickname': user['nickname'], column: user[column]} for user in ranked]
+
+    async def roster(self):
+        return [{'nickname': user['nickname'], 'gifts_sent': user['gifts_sent'],
+                 'gifts_received': user['gifts_received']}
+                for user in sorted(self._users.values(), key=lambda user: user['nickname'])]
+
+    def _delete(self, user_ids):
+        user_ids = set(user_ids)
+        for gift_id, gift in list(self._gifts.items()):
+            if gift['user_id'] in user_ids or gift['target_user_id'] in user_ids:
+                del self._gifts[gift_id]
+                if self._active.get(gift['user_id']) == gift_id:
+                    del self._active[gift['user_id']]
+        for user_id in user_ids:
+            user = self._users.pop(user_id, None)
+            if user is not None:
+                del self._nicknames[user['nickname']]
+
+    async def delete_participant(self, user_id):
+        self._delete([user_id])
+
+    async def delete_participants(self, low, high):
+        self._delete([user_id for user_id in self._users if low <= user_id < high])
+
+    async def delete_participant_ids(self, user_ids):
+        existing = [user_id for user_id in set(user_ids) if user_id in self._users]
+        self._delete(existing)
+        return existing
+
+    async def import_participants(self, records):
+        inserted = []
+        for user_id, nickname, gifts_sent, gifts_received, last_gift in records:
+            if user_id in self._users or nickname in self._nicknames:
+                continue
+            user = {'user_id': user_id, 'nickname': nickname, 'gifts_sent': gifts_sent or 0,
+                    'gifts_received': gifts_received or 0, 'last_gift': last_gift or datetime.utcnow()}
+            self._users[user_id] = user
+            self._nicknames[nickname] = user_id
+            inserted.append(self._participant(user))
+        return inserted
+
+    async def export_table(self, table, output):
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Cannot export {table}")
+
+        rows = self._users.values() if table == "user_data" else self._gifts.values()
+        with open(output, 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(EXPORT_TABLES[table])
+            writer.writerows([row[column] for column in EXPORT_TABLES[table]] for row in rows)
+        return len(rows)
+
+    async def archive_gifts(self):
+        archived = 0
+        for gift_id, gift in list(self._gifts.items()):
+            if not gift['active']:
+                del self._gifts[gift_id]
+                if gift_id not in self._archive:
+                    self._archive[gift_id] = dict(gift, archived_date=datetime.utcnow())
+                    archived += 1
+        return archived
+
+    async def record_events(self, events):
+        self._events.extend(tuple(event) for event in events)
+
+    async def export_events(self, output, since=None, until=None):
+        rows = [(number, *event) for number, event in enumerate(self._events, 1)
+                if (since is None or event[3] >= since) and (until is None or event[3] < until)]
+
+        with open(output, 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(("id",) + EVENT_COLUMNS)
+            writer.writerows(rows)
+        return len(rows)
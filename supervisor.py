@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+from metrics import Counter, Gauge, Histogram
+
+
+TASK_SECONDS = Histogram("dropbot_task_seconds", "Time background tasks take to run", ["task"])
+TASK_WAIT_SECONDS = Histogram("dropbot_task_wait_seconds", "Time background tasks wait in the queue", ["task"])
+TASK_ERRORS = Counter("dropbot_task_errors_total", "Background tasks that raised", ["task"])
+TASKS_REJECTED = Counter("dropbot_tasks_rejected_total", "Background tasks turned away by a full queue", ["task"])
+TASK_QUEUE_DEPTH = Gauge("dropbot_task_queue_depth", "Background tasks waiting to run")
+
+
+class TaskSupervisor:
+    """Runs fire-and-forget coroutines on a fixed set of workers instead of bare tasks.
+
+    At most ``concurrency`` tasks run at once, workers also hold off while every pool connection is
+    checked out. ``droppable`` tasks are refused once ``max_queue`` are waiting, the others always
+    queue, so a spike costs a few drops rather than scores. Drops are already capped upstream by
+    the cog's DropGate at ``max_concurrent_drops`` queued or running, so ``max_queue`` only bites
+    when it is set below that. Every task is timed and its exception
+    logged, and ``close`` lets the queue drain before cancelling the workers.
+    """
+
+    def __init__(self, bot, concurrency=8, max_queue=1000, pool_size=None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.pool_size = pool_size
+        self.logger = logging.getLogger("dropbot.tasks")
+
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self._closing = False
+
+        TASK_QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [self.bot.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def submit(self, name, coro, *, droppable=False):
+        """Queue ``coro`` to run as task ``name``. Returns False if it was refused."""
+        if self._closing or (droppable and self._queue.qsize() >= self.max_queue):
+            TASKS_REJECTED.inc(task=name)
+            coro.close()
+            return False
+
+        self._queue.put_nowait((name, coro, time.perf_counter()))
+        return True
+
+    async def _worker(self):
+        while True:
+            name, coro, enqueued = await self._queue.get()
+            try:
+                if self.pool_size is not None and self.bot.db is not None:
+                    await self.bot.db.wait_for_free(self.pool_size)
+
+                TASK_WAIT_SECONDS.observe(time.perf_counter() - enqueued, task=name)
+                with TASK_SECONDS.time(task=name):
+                    await coro
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                TASK_ERRORS.inc(task=name)
+                self.logger.exception(f"Background task {name} failed.")
+            finally:
+                self._queue.task_done()
+
+    async def join(self, timeout=None):
+        """Wait for everything queued so far to finish, returns False on timeout."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def close(self, timeout=30):
+        self._closing = True
+        if not await self.join(timeout):
+            self.logger.warning(f"Closing with {self._queue.qsize()} background tasks still queued.")
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        while not self._queue.empty():
+            _, coro, _ = self._queue.get_nowait()
+            coro.close()
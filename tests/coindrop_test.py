@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+import types
+
+from cogs.coindrop import CoinDrop
+from config import Config
+from storage import MemoryStorage
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def make_cog():
+    bot = types.SimpleNamespace(
+        config=Config({}),
+        storage=MemoryStorage(),
+        warmed_up=asyncio.Event(),
+        db_available=asyncio.Event(),
+        rewards=types.SimpleNamespace(note=lambda *args: None, forget=lambda predicate: None),
+        logger=logging.getLogger("dropbot"),
+    )
+    bot.db_available.set()
+    for user_id, nickname in ((1, "Alice"), (2, "Bobby"), (3, "Carol")):
+        run(bot.storage.join(user_id, nickname, str(user_id)))
+    return CoinDrop(bot)
+
+
+def test_resync_replays_changes_made_meanwhile():
+    cog = make_cog()
+    storage = cog.bot.storage
+    now = datetime.datetime.utcnow()
+    try:
+        run(cog.load_state())
+        run(storage.create_gift(1, 2, now, True))
+        cog.apply_gift(1, 2, "Bobby", now)
+
+        # while notifications were down another process reset Carol, now Alice gives up mid-resync
+        run(storage.delete_participant(3))
+        load_active_gifts = storage.load_active_gifts
+
+        async def give_up_meanwhile():
+            records = await load_active_gifts()
+            await storage.give_up(1)
+            cog.forget_gift(1)
+            return records
+
+        storage.load_active_gifts = give_up_meanwhile
+        run(cog.load_state(replace=True))
+
+        assert 3 not in cog.roster
+        assert cog.gift_index.check(1, "bobby") is None
+        assert 1 not in cog.current_gifters
+    finally:
+        cog.cog_unload()
+
+
+def test_solve_recorded_once_settled():
+    cog = make_cog()
+    storage = cog.bot.storage
+    recorded = []
+    cog.bot.events = types.SimpleNamespace(record=lambda *args: recorded.append(args))
+    cog.bot.outbox = types.SimpleNamespace(send=lambda *args, **kwargs: None, announce=lambda *args: None)
+    alice, bobby = types.SimpleNamespace(id=1), types.SimpleNamespace(id=2)
+    now = datetime.datetime.utcnow()
+    try:
+        run(storage.create_gift(1, 3, now, True))
+        run(cog.add_score(alice, now, 4.5))
+        assert recorded == [("solve", 1, 3, now, 4.5)]
+
+        # Bobby's gift was given up before the guess settled, so it isn't a solve
+        run(storage.create_gift(2, 3, now, True))
+        run(storage.give_up(2))
+        run(cog.add_score(bobby, now, 2.0))
+        assert len(recorded) == 1
+    finally:
+        cog.cog_unload()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from logs import RotatingFileHandler, SamplingFilter
+
+
+def write_lines(handler, count):
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for number in range(count):
+        handler.emit(logging.LogRecord("dropbot", logging.INFO, __file__, 0, f"line {number:04}", None, None))
+    handler.close()
+
+
+def logged_lines(directory):
+    return sorted(line for path in directory.iterdir() for line in path.read_text().splitlines())
+
+
+def test_size_rollover_keeps_every_line(tmp_path):
+    write_lines(RotatingFileHandler(str(tmp_path / "dropbot.log"), max_bytes=200, when="midnight"), 100)
+
+    assert len(list(tmp_path.iterdir())) > 3
+    assert logged_lines(tmp_path) == [f"line {number:04}" for number in range(100)]
+
+
+def test_size_rollover_prunes_oldest(tmp_path):
+    write_lines(RotatingFileHandler(str(tmp_path / "dropbot.log"), max_bytes=200, when="midnight",
+                                    backupCount=2), 40)
+
+    lines = logged_lines(tmp_path)
+    assert len(list(tmp_path.iterdir())) == 3
+    assert lines == [f"line {number:04}" for number in range(40 - len(lines), 40)]
+
+
+def test_rate_limit_spares_events():
+    rate_limit = SamplingFilter(rate_limits={"dropbot": 1})
+
+    def record(event=None):
+        record = logging.LogRecord("dropbot.drops", logging.INFO, __file__, 0, "A natural gift has dropped", None, None)
+        if event is not None:
+            record.event = event
+        return record
+
+    assert rate_limit.filter(record())
+    assert not rate_limit.filter(record())
+    assert all(rate_limit.filter(record({"event": "drop", "user_id": user_id})) for user_id in range(50))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import json
+import os
+import uuid
+
+import pytest
+
+from migrate import apply_migrations
+from roster import dummy_roster
+from storage import NOTIFY_PAYLOAD_LIMIT, MemoryStorage, PostgresStorage, StorageConflict, create_pool
+
+# e.g. postgres://postgres@localhost/travis_testdb, the Postgres tests are skipped without it
+TEST_DSN = os.environ.get("DROPBOT_TEST_DSN")
+# far above real snowflakes, so the test only ever touches its own rows
+TEST_ID_BASE = 1 << 61
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_memory_join():
+    storage = MemoryStorage()
+
+    record = run(storage.join(1, "Alice", "1"))
+    assert record['nickname'] == "Alice" and record['gifts_sent'] == 0
+
+    # a taken nickname renames the holder, as ON CONFLICT (nickname) does
+    record = run(storage.join(2, "Alice", "2"))
+    assert record['user_id'] == 1 and record['nickname'] == "2"
+
+    with pytest.raises(StorageConflict):
+        run(storage.join(1, "Bobby", "1"))
+
+
+def test_memory_gift_lifecycle():
+    storage = MemoryStorage()
+    for user_id, nickname in ((1, "Alice"), (2, "Bobby"), (3, "Carol")):
+        run(storage.join(user_id, nickname, str(user_id)))
+
+    now = datetime.datetime.utcnow()
+    assert run(storage.create_gift(1, 2, now, True))
+    assert not run(storage.create_gift(1, 3, now, True))
+    assert run(storage.create_gift(1, 2, now, False))
+    assert run(storage.has_active_gift(1))
+    assert run(storage.get_active_gift(1)) == {'nickname': "Bobby", 'user_id': 2}
+
+    run(storage.create_gift(3, 2, now, True))
+    records = run(storage.settle_gifts({1: now, 3: now, 2: now}))
+    assert len(records) == 2
+    assert all(record['target_gifts_received'] == 2 for record in records)
+    assert not run(storage.has_active_gift(1))
+
+    run(storage.create_gift(2, 1, now, True))
+    assert run(storage.give_up(2)) == "Alice"
+    assert run(storage.give_up(2)) is None
+
+    assert [record['user_id'] for record in run(storage.leaderboard('gifts_received', 1))] == [2]
+    assert [record['nickname'] for record in run(storage.roster())] == ["Alice", "Bobby", "Carol"]
+    assert run(storage.archive_gifts()) == 2
+
+    run(storage.create_gift(1, 3, now, True))
+    run(storage.delete_participant(3))
+    assert not run(storage.has_active_gift(1))
+    run(storage.delete_participants(0, 3))
+    assert run(storage.load_participants()) == []
+
+
+def test_memory_bulk_import():
+    storage = MemoryStorage()
+    run(storage.join(5, "Dummy1", "5"))
+
+    # clashing ids and nicknames are skipped, not renamed
+    inserted = run(storage.import_participants(dummy_roster(100)))
+    assert len(inserted) == 98
+    assert run(storage.get_participant(5))['nickname'] == "Dummy1"
+
+    assert sorted(run(storage.delete_participant_ids([2, 3, 5, 1000]))) == [2, 3, 5]
+    assert len(run(storage.load_participants())) == 96
+
+
+def test_forget_ids_fit_in_notifications():
+    storage = MemoryStorage()
+    published = []
+
+    async def publish(event, data):
+        published.append(json.dumps({'origin': uuid.uuid4().hex, 'event': event, 'data': data}))
+
+    storage.publish = publish
+    # the largest ids Discord can hand out, as many as a reset of a big server would delete
+    user_ids = [2 ** 64 - 1 - index for index in range(5000)]
+    run(storage.publish_forget_ids(user_ids))
+
+    assert [user_id for payload in published for user_id in json.loads(payload)['data']['user_ids']] == user_ids
+    assert all(len(payload.encode()) < NOTIFY_PAYLOAD_LIMIT for payload in published)
+
+
+@pytest.mark.skipif(not TEST_DSN, reason="DROPBOT_TEST_DSN is not set")
+def test_postgres_gift_lifecycle():
+    # a single connection, so every call checks out the one the previous call released
+    pool = run(create_pool({"dsn": TEST_DSN, "min_size": 1, "max_size": 1}))
+    storage = PostgresStorage(pool)
+    alice, bobby, carol = TEST_ID_BASE + 1, TEST_ID_BASE + 2, TEST_ID_BASE + 3
+    try:
+        run(apply_migrations(pool))
+        run(storage.delete_participants(TEST_ID_BASE, TEST_ID_BASE + 100))
+        for user_id, nickname in ((alice, "PgAlice"), (bobby, "PgBobby"), (carol, "PgCarol")):
+            assert run(storage.join(user_id, nickname, str(user_id)))['user_id'] == user_id
+        assert run(storage.get_participant(alice))['nickname'] == "PgAlice"
+
+        now = datetime.datetime.utcnow()
+        assert run(storage.create_gift(alice, bobby, now, True))
+        assert not run(storage.create_gift(alice, carol, now, True))
+        assert run(storage.has_active_gift(alice))
+        assert run(storage.get_active_gift(alice))['user_id'] == bobby
+
+        records = run(storage.settle_gifts({alice: now}))
+        assert [(record['user_id'], record['target_gifts_received']) for record in records] == [(alice, 1)]
+        assert not run(storage.has_active_gift(alice))
+
+        run(storage.create_gift(bobby, carol, now, True))
+        assert run(storage.give_up(bobby)) == "PgCarol"
+        assert run(storage.give_up(bobby)) is None
+
+        assert alice in [record['user_id'] for record in run(storage.leaderboard('gifts_sent', 1000))]
+        assert "PgBobby" in [record['nickname'] for record in run(storage.roster())]
+    finally:
+        run(storage.delete_participants(TEST_ID_BASE, TEST_ID_BASE + 100))
+        run(pool.close())
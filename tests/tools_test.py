@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import random
+
+from cogs.state import PuzzlePool
+from tools import puzzle_variants
+
+
+def test_puzzle_variants_short_names():
+    for name in ("X", "Al", "Bob", "aaa", "Dummy1"):
+        puzzles = puzzle_variants(name, rng=random.Random(name))
+        assert puzzles
+        assert len({puzzle.key for puzzle in puzzles}) == len(puzzles)
+        assert all(puzzle.label.lower() != name.lower() and puzzle.difficulty > 0 for puzzle in puzzles)
+
+
+def test_puzzle_pool_no_repeats():
+    pool = PuzzlePool(size=6)
+    pool.add(2, "Christopherson")
+
+    shown = [pool.pick(1, 2, "Christopherson", fresh=index == 0).key for index in range(30)]
+    assert len(set(shown)) == len(shown)
+
+    # the pool is generated on demand for targets it hasn't seen, and forgotten with them
+    assert pool.pick(1, 3, "Bobby").label
+    pool.forget(lambda user_id: user_id == 3)
+    assert 3 not in pool
@@ -1,4 +1,5 @@
 import random
+from collections import namedtuple
 
 from discord.ext import commands
 
@@ -23,42 +24,81 @@ def test_username(nickname: str, ctx: commands.Context) -> list:
     return errors
 
 
-async def check_has_gift(db, author_id: int) -> bool:
-    async with db.acquire() as conn:
-        check = await conn.fetchval("""
-        SELECT EXISTS (
-        SELECT 1
-        FROM gifts
-        WHERE active = TRUE and user_id = $1
-        )
-        """, author_id)
-    return check
+async def check_has_gift(storage, author_id: int) -> bool:
+    return await storage.has_active_gift(author_id)
 
 
-def secret_substring(name: str) -> str:
-    length = random.randint(3, 4)
-    start = random.randint(0, len(name) - length)
-    result = name[start:start + length]
-    return f"Part of the label has been cut off! The remaining label contains: `{result}`"
+PUZZLE_HINTS = {
+    "substring": "Part of the label has been cut off! The remaining label contains: `{}`",
+    "smudge": "The label has smudges on it. You can only make out the following letters: `{}`",
+    "scramble": "Someone scrambled the letters on the label. It reads: `{}`",
+}
 
+class Puzzle(namedtuple("Puzzle", "kind label difficulty")):
+    __slots__ = ()
 
-def secret_smudge(name: str) -> str:
-    smudged = random.sample(range(len(name)), round(len(name) * .7))
-    result = list(name)
-    for i in smudged:
-        result[i] = '#'
-    result = ''.join(result)
-    return f"The label has smudges on it. You can only make out the following letters: `{result}`"
+    @property
+    def key(self):
+        # answers are case insensitive, so labels differing only in case are the same hint
+        return self.kind, self.label.lower()
 
 
-def secret_scramble(name: str) -> str:
+def secret_substring(name: str, rng=random) -> str:
+    # never the whole name, and no more than names shorter than 4 letters can give
+    length = min(rng.randint(3, 4), len(name) - 1)
+    if length < 1:
+        return None
+    start = rng.randint(0, len(name) - length)
+    return name[start:start + length]
+
+
+def secret_smudge(name: str, rng=random) -> str:
+    smudged = set(rng.sample(range(len(name)), max(round(len(name) * .7), 1)))
+    return ''.join('#' if i in smudged else char for i, char in enumerate(name))
+
+
+def secret_scramble(name: str, rng=random) -> str:
     scrambled = list(name)
-    random.shuffle(scrambled)
-    result = ''.join(scrambled)
-    return f"Someone scrambled the letters on the label. It reads: `{result}`"
+    rng.shuffle(scrambled)
+    return ''.join(scrambled)
+
+
+SECRETS = {"substring": secret_substring, "smudge": secret_smudge, "scramble": secret_scramble}
+
+
+def puzzle_difficulty(kind: str, name: str, label: str) -> float:
+    """How much of the name a label hides, from 0 (gives it away) towards 1."""
+    if kind == "substring":
+        return 1 - len(label) / len(name)
+    # smudges and scrambles keep the length, count the letters that are not where they belong
+    return sum(a != b for a, b in zip(name.lower(), label.lower())) / len(name)
+
+
+def puzzle_variants(name: str, count: int = 12, exclude=(), rng=random) -> list:
+    """Up to ``count`` distinct puzzles for ``name``, none of them giving the name away.
+
+    Kinds are generated round robin so the pool stays mixed. Puzzle keys in ``exclude`` are
+    skipped, which lets a pool be topped up without repeating itself.
+    """
+    if not name:
+        return []
+
+    seen = set(exclude)
+    puzzles = []
+    kinds = list(SECRETS)
+    for attempt in range(count * 8):
+        if len(puzzles) == count:
+            break
+        kind = kinds[attempt % len(kinds)]
+        label = SECRETS[kind](name, rng)
+        if label is None:
+            continue
+        puzzle = Puzzle(kind, label, puzzle_difficulty(kind, name, label))
+        if puzzle.key not in seen and puzzle.difficulty > 0:
+            seen.add(puzzle.key)
+            puzzles.append(puzzle)
+    return puzzles
 
 
-def secret_string_wrapper(secret_member: str) -> str:
-    secret_array = [secret_scramble, secret_substring, secret_smudge]
-    secret_string = random.choice(secret_array)(secret_member)
-    return secret_string
+def puzzle_hint(puzzle: Puzzle) -> str:
+    return PUZZLE_HINTS[puzzle.kind].format(puzzle.label)